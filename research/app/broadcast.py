@@ -0,0 +1,222 @@
+import asyncio
+import contextlib
+import functools
+import itertools
+import time
+
+import cv2
+
+BOUNDARY = 'frame'
+MEDIA_TYPE = f'multipart/x-mixed-replace; boundary={BOUNDARY}'
+# (name, scale, JPEG quality), best first. A viewer moves down when its
+# socket can't keep up and back up once it has kept up for a while
+VARIANTS = (
+    ('full', 1.0, 80),
+    ('medium', 0.75, 60),
+    ('low', 0.5, 40),
+)
+# Share of a frame interval a send may spend waiting for the socket to drain
+# before the viewer steps down a variant
+BLOCKED_BUDGET = 0.5
+# Frames in a row sent without waiting before the viewer steps back up
+UPGRADE_AFTER = 90
+# Sends shorter than this didn't wait for the socket
+DRAIN_THRESHOLD = 0.001
+SMOOTHING = 0.2
+DEFAULT_FPS = 30
+
+
+def multipart_part(jpeg):
+    return (f'--{BOUNDARY}\r\nContent-Type: image/jpeg\r\nContent-Length: {len(jpeg)}\r\n\r\n'.encode()
+            + jpeg + b'\r\n')
+
+def encode(frame, variant):
+    _, scale, quality = variant
+    if scale != 1:
+        frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    _, jpeg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    jpeg = jpeg.tobytes()
+    return jpeg, multipart_part(jpeg)
+
+def smooth(previous, value):
+    return value if previous is None else previous + SMOOTHING * (value - previous)
+
+
+class Viewer:
+    def __init__(self, number, kind, variants):
+        self.number = number
+        self.kind = kind
+        self.variants = variants
+        self.variant = 0
+        self.frames = 0
+        self.skipped = 0
+        self.bytes = 0
+        # Bytes per second the socket sustained up to the last send it held
+        # up. Kernel buffers hide a slow socket for a while, so it is measured
+        # over everything sent since the send before that was held up
+        self.drain_rate = None
+        # Share of the frame interval spent waiting on the socket
+        self.blocked = None
+        self.clean = 0
+        self.started = time.monotonic()
+        self.window_start = self.started
+        self.window_bytes = 0
+
+    def sent(self, size, elapsed, interval, sizes):
+        # sizes are the expected bytes per frame of every variant
+        now = time.monotonic()
+        self.frames += 1
+        self.bytes += size
+        self.window_bytes += size
+        blocked = elapsed / interval
+        self.blocked = smooth(self.blocked, blocked)
+        if blocked > BLOCKED_BUDGET:
+            self.clean = 0
+            self.drain_rate = smooth(self.drain_rate, self.window_bytes / (now - self.window_start))
+            self.window_start = now
+            self.window_bytes = 0
+            # The best variant the socket keeps up with at the source's frame
+            # rate, and at least one step down. Already at the lowest one the
+            # viewer just gets fewer frames
+            fits = [index for index, expected in enumerate(sizes) if expected / interval <= self.drain_rate]
+            self.variant = min(max(fits[0] if fits else len(sizes) - 1, self.variant + 1), len(sizes) - 1)
+        elif elapsed <= DRAIN_THRESHOLD:
+            self.clean += 1
+            if self.clean >= UPGRADE_AFTER and self.variant:
+                self.clean = 0
+                self.variant -= 1
+        else:
+            self.clean = 0
+
+    def summary(self):
+        seconds = time.monotonic() - self.started
+        return {
+            'viewer': self.number,
+            'kind': self.kind,
+            'variant': self.variants[self.variant][0],
+            'frames': self.frames,
+            'skipped': self.skipped,
+            'bytes': self.bytes,
+            'fps': self.frames / seconds if seconds else 0,
+            'drain_rate': self.drain_rate,
+            'blocked': self.blocked,
+            'seconds': seconds,
+        }
+
+
+class FrameBroadcaster:
+    # Every viewer of the preview gets the newest frame the processing thread
+    # published, in the variant its connection keeps up with. A variant is
+    # encoded at most once per frame, and only when a viewer asks for it, so
+    # the cost per frame doesn't grow with the number of viewers. A slow
+    # viewer skips to the newest frame instead of queueing old ones
+    def __init__(self, variants=VARIANTS):
+        self.variants = variants
+        self.loop = None
+        # Set and replaced on every new frame, waking every waiting viewer
+        self.event = None
+        self.sequence = 0
+        self.frame = None
+        self.published = None
+        self.interval = 1 / DEFAULT_FPS
+        # Variant index -> future of (jpeg, multipart part) for the current frame
+        self.encoded = {}
+        self.encodes = {variant[0]: 0 for variant in variants}
+        # Bytes per encoded frame of each variant, None until first encoded
+        self.sizes = [None] * len(variants)
+        self.numbers = itertools.count(1)
+        self.viewers = {}
+
+    def attach(self, loop):
+        # Called from the app's startup, frames are handed to this loop
+        self.loop = loop
+        self.event = asyncio.Event()
+
+    def publish(self, frame):
+        # From the processing thread, with a BGR frame it won't write to again
+        if self.loop is None:
+            return
+        with contextlib.suppress(RuntimeError):
+            # The loop is gone during shutdown
+            self.loop.call_soon_threadsafe(self.set_frame, frame)
+
+    def set_frame(self, frame):
+        now = time.monotonic()
+        if self.published is not None:
+            self.interval = smooth(self.interval, now - self.published)
+        self.published = now
+        self.sequence += 1
+        self.frame = frame
+        self.encoded = {}
+        event, self.event = self.event, asyncio.Event()
+        event.set()
+
+    async def wait(self, sequence):
+        while self.sequence == sequence:
+            await self.event.wait()
+
+    async def variant(self, index):
+        # (sequence, jpeg, part) of the newest frame in variant index
+        sequence = self.sequence
+        future = self.encoded.get(index)
+        if future is None:
+            future = self.encoded[index] = self.loop.run_in_executor(None, encode, self.frame, self.variants[index])
+            future.add_done_callback(functools.partial(self.record_size, index))
+            self.encodes[self.variants[index][0]] += 1
+        jpeg, part = await asyncio.shield(future)
+        return sequence, jpeg, part
+
+    def record_size(self, index, future):
+        if not future.cancelled() and future.exception() is None:
+            self.sizes[index] = smooth(self.sizes[index], len(future.result()[0]))
+
+    def expected_sizes(self):
+        # A variant nobody has needed yet is guessed from the nearest encoded
+        # one by pixel count
+        known = [(index, size) for index, size in enumerate(self.sizes) if size is not None]
+        if not known:
+            return [0] * len(self.variants)
+        expected = []
+        for index, (_, scale, _) in enumerate(self.variants):
+            nearest, size = min(known, key=lambda item: abs(item[0] - index))
+            expected.append(self.sizes[index] or size * (scale / self.variants[nearest][1]) ** 2)
+        return expected
+
+    async def frames(self, kind):
+        viewer = Viewer(next(self.numbers), kind, self.variants)
+        self.viewers[viewer.number] = viewer
+        try:
+            sequence = 0
+            while True:
+                await self.wait(sequence)
+                newest, jpeg, part = await self.variant(viewer.variant)
+                if sequence:
+                    viewer.skipped += newest - sequence - 1
+                sequence = newest
+                # The consumer resumes this generator once the frame is
+                # handed to the socket, so the time in between is how long
+                # the socket took to drain
+                start = time.monotonic()
+                yield jpeg, part
+                viewer.sent(len(part) if kind == 'mjpeg' else len(jpeg), time.monotonic() - start, self.interval,
+                            self.expected_sizes())
+        finally:
+            del self.viewers[viewer.number]
+
+    async def stream(self):
+        # Body of a StreamingResponse with MEDIA_TYPE
+        async for _, part in self.frames('mjpeg'):
+            yield part
+
+    async def jpegs(self):
+        # One JPEG per WebSocket message
+        async for jpeg, _ in self.frames('websocket'):
+            yield jpeg
+
+    def stats(self):
+        return {
+            'sequence': self.sequence,
+            'fps': 1 / self.interval if self.interval else None,
+            'encodes': dict(self.encodes),
+            'viewers': [viewer.summary() for viewer in self.viewers.values()],
+        }
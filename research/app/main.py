@@ -1,37 +1,39 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.responses import StreamingResponse
 from fastapi.lifespan import Lifespan
 import asyncio
-import queue
+from broadcast import MEDIA_TYPE, FrameBroadcaster
 from process_stream import start_processing_thread
 
 app = FastAPI()
 
 input_url = "https://cph-p2p-msl.akamaized.net/hls/live/2000341/test/master.m3u8"  # Replace with your M3U8 URL
-output_queue = queue.Queue(maxsize=540)
+broadcaster = FrameBroadcaster()
 
 @app.on_event("startup")
 async def startup_event():
-    start_processing_thread(input_url, output_queue)
-
-async def video_streamer():
-    frame_interval = 1 / 30  # Frame interval in seconds (for 30fps)
-    next_frame_time = asyncio.get_event_loop().time() + frame_interval
-
-    while True:
-        try:
-            frame = output_queue.get(timeout=1)
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
-        except queue.Empty:
-            continue  # Skip the frame if the queue is empty
-
-        await asyncio.sleep(max(0, next_frame_time - asyncio.get_event_loop().time()))
-        next_frame_time += frame_interval
+    broadcaster.attach(asyncio.get_running_loop())
+    start_processing_thread(input_url, broadcaster)
 
 @app.get("/video")
 async def video_feed():
-    return StreamingResponse(video_streamer(), media_type='multipart/x-mixed-replace; boundary=frame')
+    # Every viewer gets the newest frame, in the quality its connection
+    # drains fast enough
+    return StreamingResponse(broadcaster.stream(), media_type=MEDIA_TYPE)
+
+@app.websocket("/ws")
+async def video_socket(websocket: WebSocket):
+    await websocket.accept()
+    try:
+        async for jpeg in broadcaster.jpegs():
+            await websocket.send_bytes(jpeg)
+    except WebSocketDisconnect:
+        pass
+
+@app.get("/stats")
+async def stats():
+    # Variant, frame rate, skipped frames and drain rate of every viewer
+    return broadcaster.stats()
 
 if __name__ == "__main__":
     import uvicorn
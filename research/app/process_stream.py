@@ -2,9 +2,8 @@ import cv2
 import numpy as np
 import subprocess
 import threading
-import queue
 
-def process_stream(input_url, output_queue):
+def process_stream(input_url, broadcaster):
     # FFmpeg command to fetch the M3U8 stream and output raw video frames
     ffmpeg_command = [
         'ffmpeg',
@@ -36,14 +35,11 @@ def process_stream(input_url, output_queue):
         cv2.circle(mask, (320, 240), 100, (255, 255, 255), -1)
         masked_frame = cv2.bitwise_and(frame, mask)
 
-        # Encode the frame as JPEG
-        _, jpeg_frame = cv2.imencode('.jpg', masked_frame)
+        # Encoded once and sent to every viewer
+        broadcaster.publish(masked_frame)
 
-        # Put the processed frame into the queue
-        output_queue.put(jpeg_frame.tobytes())
-
-def start_processing_thread(input_url, output_queue):
-    processing_thread = threading.Thread(target=process_stream, args=(input_url, output_queue))
+def start_processing_thread(input_url, broadcaster):
+    processing_thread = threading.Thread(target=process_stream, args=(input_url, broadcaster))
     processing_thread.daemon = True
     processing_thread.start()
 
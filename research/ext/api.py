@@ -2,25 +2,24 @@ import cv2
 import numpy as np
 import subprocess
 import threading
-import queue
+import asyncio
 import logging
 import time
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.responses import StreamingResponse
 import io
+from broadcast import MEDIA_TYPE, FrameBroadcaster
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 app = FastAPI()
 
-output_queue = queue.Queue(maxsize=180)  # Assuming you want to keep 180 frames
+broadcaster = FrameBroadcaster()
 processing_thread = None
-FRAME_RATE = 30
-FRAME_INTERVAL = 1.0 / FRAME_RATE
 
-def process_stream(input_url, output_queue):
+def process_stream(input_url, broadcaster):
     logging.info(f"Starting FFmpeg process for URL: {input_url}")
     ffmpeg_command = [
         'ffmpeg',
@@ -52,20 +51,17 @@ def process_stream(input_url, output_queue):
             cv2.circle(mask, (320, 240), 100, (255, 255, 255), -1)
             masked_frame = cv2.bitwise_and(frame, mask)
 
-            _, jpeg_frame = cv2.imencode('.jpg', masked_frame)
-            if output_queue.full():
-                output_queue.get()  # Remove the oldest frame
-            output_queue.put(jpeg_frame.tobytes())
-            logging.info("Frame processed and added to queue")
+            # Encoded once for every viewer
+            broadcaster.publish(masked_frame)
     except Exception as e:
         logging.error(f"Error during processing: {e}")
     finally:
         process.terminate()
         logging.info("FFmpeg process terminated")
 
-def check_for_new_segment(input_url, output_queue):
+def check_for_new_segment(input_url, broadcaster):
     while True:
-        process_stream(input_url, output_queue)
+        process_stream(input_url, broadcaster)
         logging.info("Checking for new segments")
         time.sleep(2)  # Check every 2 seconds for new segments
 
@@ -73,7 +69,8 @@ def check_for_new_segment(input_url, output_queue):
 async def lifespan(app: FastAPI):
     global processing_thread
     input_url = "your_input_stream_url"  # Replace with your actual input URL
-    processing_thread = threading.Thread(target=check_for_new_segment, args=(input_url, output_queue))
+    broadcaster.attach(asyncio.get_running_loop())
+    processing_thread = threading.Thread(target=check_for_new_segment, args=(input_url, broadcaster))
     processing_thread.daemon = True
     processing_thread.start()
     logging.info("Processing thread started")
@@ -83,25 +80,15 @@ async def lifespan(app: FastAPI):
 
 app = FastAPI(lifespan=lifespan)
 
-def generate_frames():
-    while True:
-        start_time = time.time()
-        if not output_queue.empty():
-            frame = output_queue.get()
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
-        else:
-            logging.info("No frames available, waiting")
-        elapsed_time = time.time() - start_time
-        time_to_wait = FRAME_INTERVAL - elapsed_time
-        if time_to_wait > 0:
-            time.sleep(time_to_wait)
-        else:
-            logging.warning("Frame processing took longer than frame interval")
-
 @app.get("/get-frame/")
 async def get_frame():
-    return StreamingResponse(generate_frames(), media_type="multipart/x-mixed-replace; boundary=frame")
+    # A slow viewer skips to the newest frame instead of taking frames from
+    # the others
+    return StreamingResponse(broadcaster.stream(), media_type=MEDIA_TYPE)
+
+@app.get("/stats")
+async def stats():
+    return broadcaster.stats()
 
 # Run the FastAPI app
 if __name__ == "__main__":
@@ -0,0 +1,165 @@
+import asyncio
+import collections
+import os
+import posixpath
+import re
+
+# Segments are held in RAM up to this many bytes across every stream
+DEFAULT_CACHE_BYTES = 256 * 1024 * 1024
+PLAYLIST_EXTENSIONS = ('.m3u8',)
+URI_ATTRIBUTE = re.compile(r'URI="([^"]+)"')
+
+
+def playlist_uris(text):
+    # Segment lines, plus URI="..." attributes such as an EXT-X-MAP init segment
+    uris = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('#'):
+            uris.extend(URI_ATTRIBUTE.findall(line))
+        else:
+            uris.append(line)
+    return uris
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        return f.read(), stat.st_mtime_ns
+
+
+class CacheEntry:
+    def __init__(self, body, mtime_ns, generation=None):
+        self.body = body
+        self.mtime_ns = mtime_ns
+        # Segment store generation, for entries mirrored from the stream
+        self.generation = generation
+
+
+class SegmentCache:
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        # Segments in least recently used order, evicted from the front when
+        # over budget
+        self.segments = collections.OrderedDict()
+        self.size = 0
+        # Playlist path -> (CacheEntry, segment paths it lists)
+        self.playlists = {}
+        # Loads in progress, so a burst of viewers asking for a new segment
+        # reads it from disk once
+        self.loading = {}
+        self.tasks = set()
+        self.hits = 0
+        self.misses = 0
+
+    async def load(self, path):
+        if path in self.loading:
+            return await asyncio.shield(self.loading[path])
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(None, read_file, path)
+        self.loading[path] = future
+        try:
+            return await future
+        finally:
+            del self.loading[path]
+
+    def store(self, path, entry):
+        if path in self.segments:
+            self.size -= len(self.segments.pop(path).body)
+        if len(entry.body) > self.max_bytes:
+            return
+        self.segments[path] = entry
+        self.size += len(entry.body)
+        while self.size > self.max_bytes:
+            _, evicted = self.segments.popitem(last=False)
+            self.size -= len(evicted.body)
+
+    def drop(self, path):
+        entry = self.segments.pop(path, None)
+        if entry is not None:
+            self.size -= len(entry.body)
+
+    async def playlist(self, path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self.forget_playlist(path)
+            return None
+        cached = self.playlists.get(path)
+        # The size catches a rewrite within the filesystem's mtime granularity
+        if cached is not None and (cached[0].mtime_ns, len(cached[0].body)) == (stat.st_mtime_ns, stat.st_size):
+            self.hits += 1
+            return cached[0]
+        self.misses += 1
+        try:
+            body, mtime_ns = await self.load(path)
+        except FileNotFoundError:
+            self.forget_playlist(path)
+            return None
+        entry = CacheEntry(body, mtime_ns)
+        directory = posixpath.dirname(path)
+        listed = set()
+        for uri in playlist_uris(body.decode('utf-8', 'replace')):
+            if '://' in uri or uri.startswith('/'):
+                continue
+            listed.add(posixpath.normpath(posixpath.join(directory, uri.split('?')[0])))
+        # Follow ffmpeg's delete_segments: whatever left the playlist leaves
+        # the cache, and new segments are loaded as soon as they show up
+        previous = cached[1] if cached is not None else set()
+        for removed in previous - listed:
+            self.drop(removed)
+        # A name can stay listed while the file behind it changes: ffmpeg
+        # rewrites an fMP4 init segment in place when the encoder restarts
+        stale = {kept for kept in listed & previous if kept in self.segments and self.changed(kept)}
+        for kept in stale:
+            self.drop(kept)
+        self.playlists[path] = (entry, listed)
+        for added in (listed - previous) | stale:
+            if added not in self.segments:
+                # In the background, the playlist goes out right away
+                task = asyncio.ensure_future(self.preload(added))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+        return entry
+
+    def changed(self, path):
+        try:
+            return os.stat(path).st_mtime_ns != self.segments[path].mtime_ns
+        except FileNotFoundError:
+            return True
+
+    async def preload(self, path):
+        try:
+            body, mtime_ns = await self.load(path)
+        except FileNotFoundError:
+            return
+        # The playlist may have moved on while the file was read
+        if self.listed(path):
+            self.store(path, CacheEntry(body, mtime_ns))
+
+    def forget_playlist(self, path):
+        cached = self.playlists.pop(path, None)
+        if cached is not None:
+            for segment in cached[1]:
+                self.drop(segment)
+
+    def listed(self, path):
+        return any(path in segments for _, segments in self.playlists.values())
+
+    async def get(self, path):
+        # None means serve it from disk: an uncached file or one no playlist lists
+        if path.endswith(PLAYLIST_EXTENSIONS):
+            return await self.playlist(path)
+        entry = self.segments.get(path)
+        if entry is not None:
+            self.segments.move_to_end(path)
+            self.hits += 1
+            return entry
+        # Only segments a playlist vouches for are cached, so eviction always
+        # has a playlist change to follow
+        if not self.listed(path):
+            return None
+        self.misses += 1
+        await self.preload(path)
+        return self.segments.get(path)
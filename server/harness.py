@@ -0,0 +1,209 @@
+import argparse
+import asyncio
+import http.client
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from cache import SegmentCache
+from server import HLSOrigin
+
+MAX_AGE = re.compile(r'max-age=(\d+)')
+
+
+class SegmentProducer:
+    # Stands in for ffmpeg: a new segment every hls_time seconds, numbered
+    # from the clock like the stream's, a playlist of the last list_size, and
+    # delete_segments for the rest
+    def __init__(self, root, hls_time, segment_bytes, list_size=5):
+        self.root = root
+        self.hls_time = hls_time
+        self.segment_bytes = segment_bytes
+        self.list_size = list_size
+        self.first_sequence = int(time.time())
+        self.sequence = self.first_sequence
+        self.stopped = threading.Event()
+
+    def write_segment(self):
+        name = f'stream{self.sequence:03d}.ts'
+        with open(os.path.join(self.root, name), 'wb') as f:
+            f.write(os.urandom(self.segment_bytes))
+        expired = self.sequence - self.list_size
+        if expired >= self.first_sequence:
+            os.remove(os.path.join(self.root, f'stream{expired:03d}.ts'))
+        first = max(self.sequence - self.list_size + 1, self.first_sequence)
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3', f'#EXT-X-TARGETDURATION:{self.hls_time}',
+                 f'#EXT-X-MEDIA-SEQUENCE:{first}']
+        for sequence in range(first, self.sequence + 1):
+            lines += [f'#EXTINF:{self.hls_time:.6f},', f'stream{sequence:03d}.ts']
+        tmp_file = os.path.join(self.root, 'stream.m3u8.tmp')
+        with open(tmp_file, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_file, os.path.join(self.root, 'stream.m3u8'))
+        self.sequence += 1
+
+    def run(self):
+        while not self.stopped.wait(0 if self.sequence == self.first_sequence else self.hls_time):
+            self.write_segment()
+
+
+def start_origin(root, hls_time, cache_bytes):
+    # The origin on its own event loop thread, on a free port
+    loop = asyncio.new_event_loop()
+    cache = SegmentCache(cache_bytes) if cache_bytes else None
+    origin = HLSOrigin(root, cache, hls_time)
+    server = loop.run_until_complete(asyncio.start_server(origin.handle, '127.0.0.1', 0))
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return server.sockets[0].getsockname()[1]
+
+
+class Viewer:
+    def __init__(self, name, url, conditional, interrupt_rate, poll_interval, stop_at):
+        self.name = name
+        parts = urllib.parse.urlsplit(url)
+        self.host = parts.netloc
+        self.secure = parts.scheme == 'https'
+        self.playlist_path = parts.path
+        self.directory = parts.path.rsplit('/', 1)[0]
+        # Conditional viewers behave like a well-mannered player or CDN: they
+        # revalidate with If-None-Match, wait out max-age, and resume cut off
+        # downloads with Range. Plain ones do none of that
+        self.conditional = conditional
+        self.interrupt_rate = interrupt_rate
+        self.poll_interval = poll_interval
+        self.stop_at = stop_at
+        self.connection = None
+        self.etag = None
+        self.fetched = set()
+        self.stats = {'bytes': 0, 'requests': 0, 'not_modified': 0, 'partial': 0, 'interrupted': 0}
+
+    def connect(self):
+        if self.connection is None:
+            connection_class = http.client.HTTPSConnection if self.secure else http.client.HTTPConnection
+            self.connection = connection_class(self.host, timeout=30)
+        return self.connection
+
+    def request(self, path, headers=None, cut=False):
+        connection = self.connect()
+        connection.request('GET', path, headers=headers or {})
+        response = connection.getresponse()
+        self.stats['requests'] += 1
+        # Status line and headers count as served bytes too
+        self.stats['bytes'] += len(str(response.msg)) + 17
+        if cut:
+            length = int(response.getheader('Content-Length', '0'))
+            body = response.read(length // 2)
+            self.stats['bytes'] += len(body)
+            self.stats['interrupted'] += 1
+            # Drop the connection mid-body like a viewer on a flaky network
+            connection.close()
+            self.connection = None
+            return response, body
+        body = response.read()
+        self.stats['bytes'] += len(body)
+        if response.status == 304:
+            self.stats['not_modified'] += 1
+        elif response.status == 206:
+            self.stats['partial'] += 1
+        return response, body
+
+    def fetch_segment(self, path):
+        cut = random.random() < self.interrupt_rate
+        response, body = self.request(path, cut=cut)
+        if response.status != 200 or not cut:
+            return
+        if self.conditional:
+            self.request(path, {'Range': f'bytes={len(body)}-', 'If-Range': response.getheader('ETag')})
+        else:
+            self.request(path)
+
+    def run(self):
+        while time.monotonic() < self.stop_at:
+            headers = {'If-None-Match': self.etag} if self.conditional and self.etag else {}
+            response, body = self.request(self.playlist_path, headers)
+            wait = self.poll_interval
+            if response.status == 200:
+                self.etag = response.getheader('ETag')
+                for line in body.decode().splitlines():
+                    if line and not line.startswith('#') and line not in self.fetched:
+                        self.fetched.add(line)
+                        self.fetch_segment(f'{self.directory}/{line}')
+            if self.conditional:
+                match = MAX_AGE.search(response.getheader('Cache-Control', ''))
+                if match:
+                    wait = max(wait, int(match.group(1)))
+            time.sleep(wait)
+
+
+def run_viewers(url, count, conditional, args):
+    stop_at = time.monotonic() + args.duration
+    viewers = [Viewer(f'{"conditional" if conditional else "plain"}-{i}', url, conditional, args.interrupt_rate,
+                      args.poll_interval, stop_at) for i in range(count)]
+    threads = [threading.Thread(target=viewer.run, daemon=True) for viewer in viewers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return viewers
+
+def print_viewers(viewers, duration):
+    print("\n{:<18} {:>12} {:>10} {:>8} {:>8} {:>12} {:>14}".format(
+        "Viewer", "Bytes", "Requests", "304", "206", "Interrupted", "MB / minute"))
+    print("-" * 88)
+    for viewer in viewers:
+        stats = viewer.stats
+        print("{:<18} {:>12} {:>10} {:>8} {:>8} {:>12} {:>14.2f}".format(
+            viewer.name, stats['bytes'], stats['requests'], stats['not_modified'], stats['partial'],
+            stats['interrupted'], stats['bytes'] / 1e6 / duration * 60))
+    print("-" * 88)
+    mean = sum(viewer.stats['bytes'] for viewer in viewers) / len(viewers)
+    print("mean {:.0f} bytes per viewer, {:.2f} MB per viewer-minute".format(mean, mean / 1e6 / duration * 60))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Counts the bytes the HLS origin serves to each simulated viewer')
+    parser.add_argument('--url', default=None,
+                        help='playlist on a running origin, by default a local origin and fake stream are started')
+    parser.add_argument('--viewers', type=int, default=10, help='viewers of each kind')
+    parser.add_argument('--mode', choices=['conditional', 'plain', 'both'], default='both')
+    parser.add_argument('--duration', type=float, default=20, help='seconds every viewer watches')
+    parser.add_argument('--poll-interval', type=float, default=0.5,
+                        help='seconds between playlist polls, conditional viewers also wait out max-age')
+    parser.add_argument('--interrupt-rate', type=float, default=0.1,
+                        help='share of segment downloads cut off halfway')
+    parser.add_argument('--hls-time', type=int, default=3)
+    parser.add_argument('--segment-bytes', type=int, default=1_000_000)
+    parser.add_argument('--cache-bytes', type=int, default=64 * 1024 * 1024)
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    url = args.url
+    producer = None
+    if url is None:
+        root = tempfile.mkdtemp(prefix='hls-harness-')
+        producer = SegmentProducer(root, args.hls_time, args.segment_bytes)
+        threading.Thread(target=producer.run, daemon=True).start()
+        port = start_origin(root, args.hls_time, args.cache_bytes)
+        url = f'http://127.0.0.1:{port}/stream.m3u8'
+        time.sleep(0.5)
+
+    modes = [True, False] if args.mode == 'both' else [args.mode == 'conditional']
+    results = {}
+    threads = [threading.Thread(target=lambda c=conditional: results.update({c: run_viewers(url, args.viewers, c, args)}))
+               for conditional in modes]
+    # Every kind of viewer watches the same stretch of the stream
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for conditional in modes:
+        print_viewers(results[conditional], args.duration)
+    if producer is not None:
+        producer.stopped.set()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+import asyncio
+import math
+import os
+import posixpath
+import re
+import time
+
+# The stream writes its short parts to PART_PLAYLIST, viewers keep asking for
+# LL_PLAYLIST and get the low-latency playlist built from it
+PART_PLAYLIST = 'parts.m3u8'
+LL_PLAYLIST = 'stream.m3u8'
+PART_TARGET = 0.5
+# MPEG-TS or fMP4 parts, whole segments keep the extension of their parts
+PART_NAME = re.compile(r'part(\d+)(\.ts|\.m4s)$')
+SEGMENT_NAME = re.compile(r'llseg(\d+)(\.ts|\.m4s)$')
+MAP_TAG = re.compile(r'^#EXT-X-MAP:.*$', re.MULTILINE)
+# How often a watched part playlist is checked for a new part. One stat per
+# stream, however many viewers are blocked on it
+POLL_INTERVAL = 0.02
+# Watchers stop when nobody asked for their stream for this long
+IDLE_TIMEOUT = 30
+# Complete segments whose parts are still listed, besides the current one
+PART_SEGMENTS = 2
+
+
+class BlockingError(Exception):
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+
+def parse_parts(text):
+    # (number, duration, uri) of every part in ffmpeg's playlist. The number
+    # comes from the file name, which -hls_start_number_source epoch_us keeps
+    # increasing across restarts of the encoder
+    parts = []
+    duration = None
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('#EXTINF:'):
+            duration = float(line[len('#EXTINF:'):].split(',')[0])
+        elif line and not line.startswith('#'):
+            match = PART_NAME.search(line)
+            if match and duration is not None:
+                parts.append((int(match.group(1)), duration, line))
+            duration = None
+    return parts
+
+
+class PartPlaylist:
+    def __init__(self, source, part_target=PART_TARGET, segment_parts=6, cache=None, store=None):
+        self.source = source
+        self.directory = posixpath.dirname(source)
+        self.part_target = part_target
+        self.segment_parts = segment_parts
+        # Whole segments are made of segment_parts parts, and may never be
+        # longer than the target duration
+        self.target_duration = math.ceil(segment_parts * part_target)
+        self.cache = cache
+        self.store = store
+        self.condition = asyncio.Condition()
+        self.version = None
+        self.mtime_ns = 0
+        self.parts = []
+        self.segments = []
+        self.current = []
+        # EXT-X-MAP of fMP4 parts, copied as is, their init segment is the
+        # same for the parts and the segments made of them
+        self.map_tag = None
+        self.body = b''
+        self.last_used = time.monotonic()
+        self.task = None
+
+    async def read_source(self):
+        if self.cache is not None:
+            entry = await self.cache.get(self.source)
+            if entry is None:
+                raise FileNotFoundError(self.source)
+            return entry.body, entry.mtime_ns
+        with open(self.source, 'rb') as f:
+            return f.read(), os.fstat(f.fileno()).st_mtime_ns
+
+    async def refresh(self):
+        # From the segment store's mirror when it has the playlist, so a new
+        # part is seen as soon as ffmpeg has uploaded it
+        entry = self.store.get(self.source) if self.store is not None else None
+        if entry is not None:
+            version = (entry.mtime_ns, len(entry.body))
+        else:
+            try:
+                stat = os.stat(self.source)
+            except FileNotFoundError:
+                return
+            version = (stat.st_mtime_ns, stat.st_size)
+        if version == self.version:
+            return
+        if entry is not None:
+            body, mtime_ns = entry.body, entry.mtime_ns
+        else:
+            try:
+                body, mtime_ns = await self.read_source()
+            except FileNotFoundError:
+                return
+        self.version = version
+        self.mtime_ns = mtime_ns
+        text = body.decode('utf-8', 'replace')
+        self.parts = parse_parts(text)
+        match = MAP_TAG.search(text)
+        self.map_tag = match.group(0).strip() if match else None
+        self.group()
+        self.body = self.render().encode()
+        async with self.condition:
+            self.condition.notify_all()
+
+    def group(self):
+        # Part n belongs to segment n // segment_parts. A segment is complete
+        # once all of its parts are listed in order; parts before the first
+        # segment boundary (right after the encoder started) are skipped
+        groups = {}
+        for part in self.parts:
+            groups.setdefault(part[0] // self.segment_parts, []).append(part)
+        segments = []
+        current = []
+        for msn in sorted(groups):
+            parts = groups[msn]
+            numbers = [part[0] for part in parts]
+            contiguous = numbers == list(range(msn * self.segment_parts, msn * self.segment_parts + len(parts)))
+            if not contiguous:
+                segments = []
+                current = []
+                continue
+            if len(parts) == self.segment_parts:
+                segments.append((msn, parts))
+            else:
+                # Only the newest group may be partial
+                current = parts
+        if current and segments and current[0][0] // self.segment_parts != segments[-1][0] + 1:
+            current = []
+        self.segments = segments
+        self.current = current
+
+    def next_msn(self):
+        # Segment the current parts belong to
+        if self.current:
+            return self.current[0][0] // self.segment_parts
+        if self.segments:
+            return self.segments[-1][0] + 1
+        return None
+
+    def render(self):
+        lines = [
+            '#EXTM3U',
+            '#EXT-X-VERSION:9',
+            f'#EXT-X-TARGETDURATION:{self.target_duration}',
+            f'#EXT-X-PART-INF:PART-TARGET={self.part_target:.3f}',
+            # Three parts back from the live edge, as the spec's minimum
+            f'#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES,PART-HOLD-BACK={3 * self.part_target:.3f}',
+        ]
+        first_msn = self.segments[0][0] if self.segments else self.next_msn() or 0
+        lines.append(f'#EXT-X-MEDIA-SEQUENCE:{first_msn}')
+        if self.map_tag:
+            lines.append(self.map_tag)
+        extension = PART_NAME.search(self.parts[-1][2]).group(2) if self.parts else '.ts'
+        for index, (msn, parts) in enumerate(self.segments):
+            if index >= len(self.segments) - PART_SEGMENTS:
+                lines.extend(self.part_lines(parts))
+            duration = sum(part[1] for part in parts)
+            lines.append(f'#EXTINF:{duration:.5f},')
+            lines.append(f'llseg{msn}{extension}')
+        lines.extend(self.part_lines(self.current))
+        if self.parts:
+            next_part = self.parts[-1][0] + 1
+            lines.append(f'#EXT-X-PRELOAD-HINT:TYPE=PART,URI="part{next_part}{extension}"')
+        return '\n'.join(lines) + '\n'
+
+    def part_lines(self, parts):
+        # Every part starts on a keyframe, the stream sets -g to one part
+        return [f'#EXT-X-PART:DURATION={duration:.5f},URI="{uri}",INDEPENDENT=YES' for _, duration, uri in parts]
+
+    def contains(self, msn, part=None):
+        if self.segments and msn <= self.segments[-1][0]:
+            return True
+        if part is None or not self.current:
+            return False
+        current_msn = self.current[0][0] // self.segment_parts
+        return msn < current_msn or (msn == current_msn and part < len(self.current))
+
+    def has_part(self, number):
+        return bool(self.parts) and number <= self.parts[-1][0]
+
+    def segment_part_paths(self, msn):
+        for segment_msn, parts in self.segments:
+            if segment_msn == msn:
+                return [posixpath.join(self.directory, uri) for _, _, uri in parts]
+        return None
+
+    async def wait(self, satisfied, timeout):
+        deadline = time.monotonic() + timeout
+        async with self.condition:
+            while not satisfied():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                try:
+                    await asyncio.wait_for(self.condition.wait(), remaining)
+                except asyncio.TimeoutError:
+                    return satisfied()
+        return True
+
+    async def block(self, msn, part):
+        # Hold an _HLS_msn/_HLS_part request until the playlist has that part
+        next_msn = self.next_msn()
+        if next_msn is not None and msn > next_msn + 2:
+            # Too far in the future to be a real player's request
+            raise BlockingError(400)
+        if not await self.wait(lambda: self.contains(msn, part), 3 * self.target_duration):
+            raise BlockingError(503)
+
+    async def block_part(self, number):
+        # The preload hint lets players ask for the next part before it
+        # exists; its request waits here until ffmpeg has finished writing it
+        if not self.parts or number != self.parts[-1][0] + 1:
+            return False
+        return await self.wait(lambda: self.has_part(number), 3 * self.part_target + 1)
+
+    async def watch(self):
+        while time.monotonic() - self.last_used < IDLE_TIMEOUT:
+            await self.refresh()
+            await asyncio.sleep(POLL_INTERVAL)
+
+
+class LowLatencyOrigin:
+    def __init__(self, part_target=PART_TARGET, segment_parts=6, cache=None, store=None):
+        self.part_target = part_target
+        self.segment_parts = segment_parts
+        self.cache = cache
+        self.store = store
+        self.playlists = {}
+
+    def exists(self, path):
+        return (self.store is not None and self.store.get(path) is not None) or os.path.exists(path)
+
+    async def playlist(self, directory):
+        # The part playlist next to the requested path, or None when that
+        # stream isn't running in low-latency mode
+        source = posixpath.join(directory, PART_PLAYLIST)
+        playlist = self.playlists.get(source)
+        if playlist is None:
+            if not self.exists(source):
+                return None
+            playlist = self.playlists[source] = PartPlaylist(source, self.part_target, self.segment_parts, self.cache,
+                                                             self.store)
+        playlist.last_used = time.monotonic()
+        if playlist.task is None or playlist.task.done():
+            await playlist.refresh()
+            playlist.task = asyncio.ensure_future(playlist.watch())
+        return playlist
+
+    async def segment_body(self, paths):
+        # A whole segment is its parts back to back. MPEG-TS concatenates as
+        # is, and so do fMP4 fragments sharing one init segment
+        bodies = []
+        mtime_ns = 0
+        for path in paths:
+            entry = self.store.get(path) if self.store is not None else None
+            if entry is None and self.cache is not None:
+                entry = await self.cache.get(path)
+            if entry is not None:
+                body, part_mtime_ns = entry.body, entry.mtime_ns
+            else:
+                with open(path, 'rb') as f:
+                    body, part_mtime_ns = f.read(), os.fstat(f.fileno()).st_mtime_ns
+            bodies.append(body)
+            mtime_ns = max(mtime_ns, part_mtime_ns)
+        return b''.join(bodies), mtime_ns
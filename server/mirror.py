@@ -0,0 +1,65 @@
+import asyncio
+import json
+import os
+
+from cache import CacheEntry
+
+# The stream's segment store publishes on this socket (processor.py --store-socket)
+STORE_SOCKET = '/run/morph/segments.sock'
+# Seconds between attempts to reach a store that isn't up (yet)
+RECONNECT_INTERVAL = 1
+
+
+class StoreMirror:
+    # A copy of the stream's in-memory segment store, kept up to date over
+    # its Unix socket. While the store can't be reached the mirror is empty
+    # and everything is served from disk
+    def __init__(self, root, socket_path=STORE_SOCKET):
+        self.root = os.path.realpath(root)
+        self.socket_path = socket_path
+        # Absolute path -> CacheEntry, with the store generation it came from
+        self.entries = {}
+        self.generation = 0
+        self.connected = False
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.follow())
+
+    async def follow(self):
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.socket_path)
+            except (FileNotFoundError, ConnectionError):
+                await asyncio.sleep(RECONNECT_INTERVAL)
+                continue
+            self.connected = True
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    header = json.loads(line)
+                    self.apply(header, await reader.readexactly(header['size']))
+            except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+                pass
+            finally:
+                writer.close()
+                # Changes made while disconnected are unknown, the snapshot
+                # sent on reconnect starts over
+                self.connected = False
+                self.entries.clear()
+            await asyncio.sleep(RECONNECT_INTERVAL)
+
+    def apply(self, header, body):
+        # Every update carries the store generation after it. A file arrives
+        # whole or not at all, so an entry is never half a segment
+        path = os.path.join(self.root, header['path'])
+        if header['op'] == 'put':
+            self.entries[path] = CacheEntry(body, header['mtime_ns'], header['generation'])
+        elif header['op'] == 'delete':
+            self.entries.pop(path, None)
+        self.generation = header['generation']
+
+    def get(self, path):
+        return self.entries.get(path)
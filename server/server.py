@@ -1,30 +1,450 @@
-import http.server
-import socketserver
+import argparse
+import asyncio
+import email.utils
+import mimetypes
+import os
+import posixpath
+import signal
+import socket
 import ssl
+import time
+import traceback
+import urllib.parse
 
-class CORSRequestHandler(http.server.SimpleHTTPRequestHandler):
-    def end_headers(self):
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, PUT, DELETE, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'x-api-key,Content-Type')
-        super().end_headers()
+from cache import DEFAULT_CACHE_BYTES, SegmentCache
+from llhls import LL_PLAYLIST, PART_NAME, PART_TARGET, SEGMENT_NAME, BlockingError, LowLatencyOrigin
+from mirror import STORE_SOCKET, StoreMirror
 
-def main():
-    PORT = 8000
-    Handler = CORSRequestHandler
+PORT = 8000
+HLS_DIR = '/tmp/hls'
+CERT_FILE = '/etc/letsencrypt/live/worthyrae.com/fullchain.pem'
+KEY_FILE = '/etc/letsencrypt/live/worthyrae.com/privkey.pem'
+# Idle keep-alive connections are closed after this many seconds
+KEEP_ALIVE_TIMEOUT = 15
+MAX_HEADER_BYTES = 16 * 1024
+# Playlists are rewritten every segment, read them whole instead of streaming
+SMALL_FILE_BYTES = 64 * 1024
+# Matches the stream's -hls_time, playlists may be cached for half of it
+HLS_TIME = 3
+# Resumption tickets handed out per TLS 1.3 handshake
+TLS_TICKETS = 2
+# Everything but playlists. The stream numbers segments from the clock
+# (-hls_start_number_source) and names every encoder run's fMP4 init segment
+# after its start, so a URL never gets different bytes, not even after an
+# encoder restart
+SEGMENT_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
+    'Access-Control-Allow-Headers': 'x-api-key,Content-Type',
+}
+CONTENT_TYPES = {
+    '.m3u8': 'application/vnd.apple.mpegurl',
+    '.ts': 'video/mp2t',
+    '.m4s': 'video/iso.segment',
+    '.mp4': 'video/mp4',
+}
+REASONS = {
+    200: 'OK',
+    204: 'No Content',
+    206: 'Partial Content',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    416: 'Range Not Satisfiable',
+    431: 'Request Header Fields Too Large',
+    503: 'Service Unavailable',
+}
+
+
+def content_type(path):
+    extension = posixpath.splitext(path)[1].lower()
+    if extension in CONTENT_TYPES:
+        return CONTENT_TYPES[extension]
+    return mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+def parse_request(data):
+    lines = data.decode('latin-1').split('\r\n')
+    method, target, version = lines[0].split(' ')
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return method, target, version, headers
+
+def make_etag(mtime_ns, size):
+    # Strong: ffmpeg never rewrites a file in place without changing these
+    return f'"{mtime_ns:x}-{size:x}"'
+
+def etag_matches(header, etag):
+    if header.strip() == '*':
+        return True
+    return etag in (tag.strip() for tag in header.split(','))
+
+def parse_range(header, size):
+    # (start, end) inclusive for a single bytes range, None to send the whole
+    # file, or 'unsatisfiable'. Multiple ranges are answered with the whole file
+    unit, _, spec = header.partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        return None
+    first, _, last = spec.strip().partition('-')
+    try:
+        if not first:
+            length = int(last)
+            if length <= 0:
+                return 'unsatisfiable'
+            return max(size - length, 0), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return 'unsatisfiable'
+    return start, min(end, size - 1)
+
+def wants_keep_alive(version, headers):
+    connection = headers.get('connection', '').lower()
+    if version == 'HTTP/1.1':
+        return connection != 'close'
+    return connection == 'keep-alive'
+
+
+class HLSOrigin:
+    def __init__(self, root, cache=None, hls_time=HLS_TIME, low_latency=None, store=None):
+        self.root = os.path.realpath(root)
+        self.cache = cache
+        # Mirror of the stream's segment store, checked before the cache and disk
+        self.store = store
+        # Builds LL-HLS playlists for streams that write parts
+        self.low_latency = low_latency
+        # Short enough that players and CDNs still see every new segment in time
+        self.playlist_cache_control = f'public, max-age={max(hls_time // 2, 1)}'
+
+    def cache_control(self, path):
+        if path.endswith('.m3u8'):
+            return self.playlist_cache_control
+        return SEGMENT_CACHE_CONTROL
+
+    def resolve(self, target):
+        # Only paths inside root, never anything reached with ..
+        path = urllib.parse.unquote(urllib.parse.urlsplit(target).path)
+        path = posixpath.normpath(path).lstrip('/')
+        try:
+            full_path = os.path.realpath(os.path.join(self.root, path))
+        except ValueError:
+            # An escaped NUL byte
+            return None
+        if not full_path.startswith(self.root + os.sep):
+            return None
+        return full_path
+
+    async def send_head(self, writer, status, headers, keep_alive):
+        lines = [f'HTTP/1.1 {status} {REASONS[status]}']
+        headers = dict(headers)
+        headers.update(CORS_HEADERS)
+        headers['Date'] = email.utils.formatdate(usegmt=True)
+        headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+        if keep_alive:
+            headers['Keep-Alive'] = f'timeout={KEEP_ALIVE_TIMEOUT}'
+        lines.extend(f'{name}: {value}' for name, value in headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+
+    async def send_error(self, writer, status, keep_alive):
+        body = f'{status} {REASONS[status]}\n'.encode()
+        await self.send_head(writer, status, {'Content-Type': 'text/plain', 'Content-Length': len(body)}, keep_alive)
+        writer.write(body)
+        await writer.drain()
+
+    async def send_body(self, writer, request_headers, path, method, keep_alive, size, mtime_ns,
+                        body=None, file=None, cache_control=None):
+        # Either body holds the whole file, or it is streamed from file
+        etag = make_etag(mtime_ns, size)
+        headers = {
+            'Content-Type': content_type(path),
+            'Cache-Control': cache_control or self.cache_control(path),
+            'ETag': etag,
+            'Last-Modified': email.utils.formatdate(mtime_ns / 1e9, usegmt=True),
+            'Accept-Ranges': 'bytes',
+        }
+        if etag_matches(request_headers.get('if-none-match', ''), etag):
+            await self.send_head(writer, 304, headers, keep_alive)
+            return
+
+        status, start, end = 200, 0, size - 1
+        byte_range = None
+        if 'range' in request_headers and method == 'GET':
+            # A stale If-Range means the client's partial copy is outdated
+            if_range = request_headers.get('if-range')
+            if if_range is None or if_range == etag:
+                byte_range = parse_range(request_headers['range'], size)
+        if byte_range == 'unsatisfiable':
+            headers['Content-Range'] = f'bytes */{size}'
+            headers['Content-Length'] = 0
+            await self.send_head(writer, 416, headers, keep_alive)
+            return
+        if byte_range is not None:
+            status, (start, end) = 206, byte_range
+            headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+        length = end - start + 1 if size else 0
+        headers['Content-Length'] = length
+        await self.send_head(writer, status, headers, keep_alive)
+        if method == 'HEAD' or not length:
+            return
+        if body is not None:
+            writer.write(memoryview(body)[start:end + 1])
+            await writer.drain()
+            return
+        # os.sendfile straight from the page cache on plain sockets. Over
+        # TLS asyncio falls back to reading chunks in its executor
+        loop = asyncio.get_running_loop()
+        await loop.sendfile(writer.transport, file, start, length)
 
-    # Create an SSL context
+    async def send_low_latency(self, writer, request_headers, path, target, method, keep_alive):
+        # True when the request was answered as LL-HLS
+        name = posixpath.basename(path)
+        playlist = await self.low_latency.playlist(posixpath.dirname(path))
+        if playlist is None:
+            return False
+        if name == LL_PLAYLIST:
+            query = urllib.parse.parse_qs(urllib.parse.urlsplit(target).query)
+            cache_control = 'no-cache'
+            if '_HLS_msn' in query:
+                try:
+                    msn = int(query['_HLS_msn'][0])
+                    part = int(query['_HLS_part'][0]) if '_HLS_part' in query else None
+                    await playlist.block(msn, part)
+                except ValueError:
+                    await self.send_error(writer, 400, keep_alive)
+                    return True
+                except BlockingError as e:
+                    await self.send_error(writer, e.status, keep_alive)
+                    return True
+                # The answer to a blocking request never changes, so caches
+                # in front of the origin can share it between viewers
+                cache_control = f'public, max-age={3 * playlist.target_duration}'
+            await self.send_body(writer, request_headers, path, method, keep_alive, len(playlist.body),
+                                 playlist.mtime_ns, body=playlist.body, cache_control=cache_control)
+            return True
+        match = SEGMENT_NAME.search(name)
+        if match:
+            paths = playlist.segment_part_paths(int(match.group(1)))
+            if paths is None:
+                await self.send_error(writer, 404, keep_alive)
+                return True
+            try:
+                body, mtime_ns = await self.low_latency.segment_body(paths)
+            except FileNotFoundError:
+                await self.send_error(writer, 404, keep_alive)
+                return True
+            await self.send_body(writer, request_headers, path, method, keep_alive, len(body), mtime_ns, body=body)
+            return True
+        match = PART_NAME.search(name)
+        if match and not self.low_latency.exists(path):
+            # Let the preload hint's request wait for its part, then serve it
+            # like any other file
+            await playlist.block_part(int(match.group(1)))
+        return False
+
+    async def send_cached(self, writer, request_headers, path, method, keep_alive):
+        entry = self.store.get(path) if self.store is not None else None
+        if entry is None and self.cache is not None:
+            entry = await self.cache.get(path)
+        if entry is None:
+            return False
+        await self.send_body(writer, request_headers, path, method, keep_alive, len(entry.body), entry.mtime_ns,
+                             body=entry.body)
+        return True
+
+    async def send_file(self, writer, request_headers, path, method, keep_alive):
+        if not os.path.isfile(path):
+            await self.send_error(writer, 404, keep_alive)
+            return
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            # ffmpeg deleted the segment between the check and open
+            await self.send_error(writer, 404, keep_alive)
+            return
+        with f:
+            stat = os.fstat(f.fileno())
+            body = f.read() if stat.st_size <= SMALL_FILE_BYTES else None
+            size = len(body) if body is not None else stat.st_size
+            await self.send_body(writer, request_headers, path, method, keep_alive, size, stat.st_mtime_ns,
+                                 body=body, file=f)
+
+    async def handle(self, reader, writer):
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    data = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), KEEP_ALIVE_TIMEOUT)
+                except asyncio.LimitOverrunError:
+                    await self.send_error(writer, 431, False)
+                    return
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                    return
+                try:
+                    method, target, version, headers = parse_request(data)
+                except ValueError:
+                    await self.send_error(writer, 400, False)
+                    return
+                keep_alive = wants_keep_alive(version, headers)
+                if headers.get('content-length', '0') != '0' or 'transfer-encoding' in headers:
+                    # Bodies are never read, so the connection can't be reused
+                    keep_alive = False
+
+                if method == 'OPTIONS':
+                    await self.send_head(writer, 204, {'Content-Length': 0}, keep_alive)
+                elif method not in ('GET', 'HEAD'):
+                    await self.send_error(writer, 405, keep_alive)
+                else:
+                    path = self.resolve(target)
+                    if path is None:
+                        await self.send_error(writer, 404, keep_alive)
+                    elif self.low_latency is not None and await self.send_low_latency(
+                            writer, headers, path, target, method, keep_alive):
+                        pass
+                    elif not await self.send_cached(writer, headers, path, method, keep_alive):
+                        await self.send_file(writer, headers, path, method, keep_alive)
+        except (ConnectionError, ssl.SSLError):
+            # Viewers disconnect mid-segment all the time
+            pass
+        finally:
+            writer.close()
+
+
+def ssl_context(certfile, keyfile):
+    if not (os.path.exists(certfile) and os.path.exists(keyfile)):
+        return None
     context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-    
-    # Load your SSL certificate and key
-    context.load_cert_chain(certfile='/etc/letsencrypt/live/worthyrae.com/fullchain.pem', 
-                            keyfile='/etc/letsencrypt/live/worthyrae.com/privkey.pem')
-
-    with socketserver.TCPServer(("", PORT), Handler) as httpd:
-        # Wrap the socket with the SSL context
-        httpd.socket = context.wrap_socket(httpd.socket, server_side=True)
-        print("serving at port", PORT)
-        httpd.serve_forever()
+    context.load_cert_chain(certfile=certfile, keyfile=keyfile)
+    # Session tickets are encrypted with keys held in the context. Workers
+    # forked after this share those keys, so a viewer resumes its session on
+    # whichever worker the kernel hands the next connection to
+    context.options &= ~ssl.OP_NO_TICKET
+    context.num_tickets = TLS_TICKETS
+    return context
+
+def listen_socket(host, port, backlog):
+    # Without SO_REUSEPORT the workers share this one socket instead
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+async def serve(args, context=None, sock=None, reuse_port=False):
+    cache = SegmentCache(args.cache_bytes) if args.cache_bytes else None
+    store = None
+    if args.store_socket:
+        # Every worker follows the store on its own connection
+        store = StoreMirror(args.root, args.store_socket)
+        store.start()
+    low_latency = None
+    if args.low_latency:
+        segment_parts = max(round(args.hls_time / args.part_target), 1)
+        low_latency = LowLatencyOrigin(args.part_target, segment_parts, cache, store)
+    origin = HLSOrigin(args.root, cache, args.hls_time, low_latency, store)
+    if sock is not None:
+        server = await asyncio.start_server(origin.handle, sock=sock, ssl=context, limit=MAX_HEADER_BYTES)
+    else:
+        # With reuse_port every worker binds its own socket and the kernel
+        # spreads new connections between them
+        server = await asyncio.start_server(origin.handle, host=args.host, port=args.port, ssl=context,
+                                            backlog=args.backlog, limit=MAX_HEADER_BYTES, reuse_port=reuse_port)
+    async with server:
+        await server.serve_forever()
+
+def run_worker(args, context, sock):
+    try:
+        asyncio.run(serve(args, context, sock, reuse_port=sock is None))
+    except KeyboardInterrupt:
+        pass
+
+def fork_worker(args, context, sock):
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            run_worker(args, context, sock)
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+    return pid
+
+def run_workers(args, context):
+    sock = None if hasattr(socket, 'SO_REUSEPORT') else listen_socket(args.host, args.port, args.backlog)
+    workers = {fork_worker(args, context, sock) for _ in range(args.workers)}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while workers:
+        pid, status = os.wait()
+        workers.discard(pid)
+        if not stopping:
+            # A crashed worker is replaced so the port keeps all its cores
+            print(f'Worker {pid} exited with status {status}, restarting')
+            time.sleep(1)
+            workers.add(fork_worker(args, context, sock))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='HLS origin for the processed streams')
+    parser.add_argument('--host', default='')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--root', default=HLS_DIR, help='directory the playlists and segments are served from')
+    parser.add_argument('--certfile', default=CERT_FILE)
+    parser.add_argument('--keyfile', default=KEY_FILE)
+    parser.add_argument('--cache-bytes', type=int, default=DEFAULT_CACHE_BYTES,
+                        help='memory for cached playlists and segments, 0 serves everything from disk')
+    parser.add_argument('--hls-time', type=int, default=HLS_TIME,
+                        help='segment length the stream writes, playlists are cached for half of it')
+    parser.add_argument('--backlog', type=int, default=1024, help='pending connections the kernel queues')
+    parser.add_argument('--low-latency', action='store_true',
+                        help='serve LL-HLS for streams that write parts (processor.py --low-latency), with '
+                             'blocking playlist reloads and --hls-time segments stitched from the parts')
+    parser.add_argument('--part-target', type=float, default=PART_TARGET,
+                        help='part length the stream writes in low-latency mode')
+    parser.add_argument('--store-socket', nargs='?', const=STORE_SOCKET, default=None,
+                        help=f'serve from the stream\'s in-memory segment store on this Unix socket (default '
+                             f'{STORE_SOCKET}), falling back to --root while it is unreachable')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes serving the port, each with its own --cache-bytes. Use one per core so TLS '
+                             'handshakes and encryption are not capped at one core')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    # Built before forking so every worker shares the session ticket keys
+    context = ssl_context(args.certfile, args.keyfile)
+    if context is None:
+        print(f'No certificate at {args.certfile}, serving plain HTTP')
+    print("serving at port", args.port, "with", args.workers, "workers" if args.workers > 1 else "worker")
+    if args.workers > 1:
+        run_workers(args, context)
+        return
+    try:
+        asyncio.run(serve(args, context))
+    except KeyboardInterrupt:
+        pass
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,293 @@
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from edges import StripEdgeDetector, detect_edges
+from filters import LOOKS, build_graph
+from ingest import read_frame_into
+from metrics import LatencyHistogram
+from processor import SEGMENT_TYPES, output_ffmpeg_command
+from render import PIXEL_FORMATS, Renderer
+from schedule import get_schedule
+
+RESOLUTIONS = {
+    '480p': (640, 480),
+    '720p': (1280, 720),
+    '1080p': (1920, 1080),
+    '4k': (3840, 2160),
+}
+
+
+def synthetic_frames(width, height, count, seed=0):
+    # Smooth noise with a few moving blocks, so Canny has edges to find
+    rng = np.random.default_rng(seed)
+    background = cv2.GaussianBlur(rng.integers(0, 256, (height, width), dtype=np.uint8), (0, 0), 3)
+    frames = np.empty((count, height, width), dtype=np.uint8)
+    for i in range(count):
+        frame = frames[i]
+        frame[:] = background
+        for block in range(8):
+            x = (block * width // 8 + i * 4) % width
+            y = (block * height // 8 + i * 2) % height
+            cv2.rectangle(frame, (x, y), (x + width // 12, y + height // 10), 40 + block * 25, -1)
+    return frames
+
+def recorded_frames(path, source_size, width, height, count):
+    source_width, source_height = source_size
+    raw = np.fromfile(path, dtype=np.uint8)
+    available = raw.size // (source_width * source_height)
+    if not available:
+        raise ValueError(f'{path} holds no complete {source_width}x{source_height} frame')
+    raw = raw[:available * source_width * source_height].reshape((available, source_height, source_width))
+    frames = np.empty((count, height, width), dtype=np.uint8)
+    for i in range(count):
+        cv2.resize(raw[i % available], (width, height), dst=frames[i], interpolation=cv2.INTER_AREA)
+    return frames
+
+def open_sink(width, height, fps, pix_fmt, use_ffmpeg):
+    if not use_ffmpeg:
+        return open(os.devnull, 'wb'), None
+    ffmpeg_command = [
+        'ffmpeg', '-loglevel', 'error',
+        '-f', 'rawvideo',
+        '-pix_fmt', pix_fmt,
+        '-s', f'{width}x{height}',
+        '-r', str(fps),
+        '-i', '-',
+        '-c:v', 'libx264',
+        '-b:v', '5000k',
+        '-preset', 'fast',
+        '-tune', 'zerolatency',
+        '-f', 'null', '-'
+    ]
+    process = subprocess.Popen(ffmpeg_command, stdin=subprocess.PIPE)
+    return process.stdin, process
+
+def timed(histogram, function, *args, **kwargs):
+    start = time.perf_counter_ns()
+    result = function(*args, **kwargs)
+    histogram.record(time.perf_counter_ns() - start)
+    return result
+
+def benchmark_resolution(frames, args, decompose=True):
+    count, height, width = frames.shape
+    schedule = get_schedule(51.537052, -0.183325, 'Europe/London')
+    renderer = Renderer(width, height, args.pix_fmt)
+    strips = StripEdgeDetector(width, height, strips=args.strips) if args.strips != 1 else None
+    detect = detect_edges if strips is None else strips.detect
+    graph = build_graph(args.filters, width, height, decompose=decompose)
+    if graph is not None:
+        detect = graph.run
+    edges = np.empty((height, width), dtype=np.uint8)
+    frame = np.empty((height, width), dtype=np.uint8)
+    source = io.BytesIO(frames.tobytes())
+    sink, process = open_sink(width, height, args.fps, args.pix_fmt, args.ffmpeg)
+    stages = {stage: LatencyHistogram() for stage in ('get_frame', 'get_colors', 'edges', 'colorize', 'send_output', 'total')}
+
+    # Warm up caches and the color table outside of the measurements
+    schedule.colors()
+    renderer.render(detect_edges(frames[0], out=edges), (0, 0, 0), (255, 255, 255))
+
+    start = time.perf_counter_ns()
+    try:
+        for _ in range(args.repeat):
+            source.seek(0)
+            for _ in range(count):
+                frame_start = time.perf_counter_ns()
+                timed(stages['get_frame'], read_frame_into, source, frame)
+                background_color, line_color = timed(stages['get_colors'], schedule.colors)
+                timed(stages['edges'], detect, frame, out=edges)
+                if graph is not None:
+                    for name, value in graph.times.items():
+                        stages.setdefault(f'filter.{name}', LatencyHistogram()).record(value)
+                output = timed(stages['colorize'], renderer.render, edges, background_color, line_color)
+                timed(stages['send_output'], sink.write, output.data)
+                stages['total'].record(time.perf_counter_ns() - frame_start)
+    finally:
+        sink.close()
+        if process is not None:
+            process.wait()
+    elapsed = (time.perf_counter_ns() - start) / 1e9
+
+    mismatch = None
+    if strips is not None:
+        # Seam artifacts, checked after the timed passes
+        mismatch = max(strips.verify(frames[i], strips.detect(frames[i])) for i in range(count))
+        strips.close()
+
+    results = {}
+    for stage, histogram in stages.items():
+        summary = histogram.summary()
+        summary['throughput_fps'] = 1e9 / summary['mean'] if summary['mean'] else None
+        results[stage] = summary
+    return {
+        'width': width,
+        'height': height,
+        'frames': count * args.repeat,
+        'elapsed': elapsed,
+        'fps': count * args.repeat / elapsed,
+        'strips': len(strips.strips) if strips is not None else 1,
+        'strip_mismatch': mismatch,
+        'stages': results,
+    }
+
+def segment_bytes(frames, args, segment_type):
+    # Size of the HLS output the processor's encoder settings give for these
+    # frames, every segment kept
+    count, height, width = frames.shape
+    renderer = Renderer(width, height, args.pix_fmt)
+    edges = np.empty((height, width), dtype=np.uint8)
+    background_color, line_color = get_schedule(51.537052, -0.183325, 'Europe/London').colors()
+    with tempfile.TemporaryDirectory(prefix='segments-') as output_dir:
+        ffmpeg_command = output_ffmpeg_command(width, height, args.fps, output_dir, args.pix_fmt,
+                                               segment_type=segment_type, list_size=0)
+        process = subprocess.Popen(ffmpeg_command, stdin=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try:
+            for _ in range(args.repeat):
+                for frame in frames:
+                    output = renderer.render(detect_edges(frame, out=edges), background_color, line_color)
+                    process.stdin.write(output.data)
+        finally:
+            process.stdin.close()
+            process.wait()
+        # Media segments and the fMP4 init segment, not the playlist
+        names = [name for name in os.listdir(output_dir) if not name.endswith('.m3u8')]
+        total = sum(os.path.getsize(os.path.join(output_dir, name)) for name in names)
+    minutes = count * args.repeat / args.fps / 60
+    return {'bytes': total, 'files': len(names), 'bytes_per_minute': total / minutes}
+
+def print_results(name, result, budget_ns):
+    print("\n{} ({}x{}): {:.1f} fps over {} frames".format(
+        name, result['width'], result['height'], result['fps'], result['frames']))
+    print("{:<20} {:>12} {:>12} {:>12} {:>12} {:>14}".format(
+        "Operation", "p50 (us)", "p99 (us)", "max (us)", "Stage fps", "p99 % Budget"))
+    print("-" * 86)
+    for stage, summary in result['stages'].items():
+        print("{:<20} {:>12.1f} {:>12.1f} {:>12.1f} {:>12.0f} {:>13.2f}%".format(
+            stage, summary['p50'] / 1e3, summary['p99'] / 1e3, summary['max'] / 1e3,
+            summary['throughput_fps'] or 0, summary['p99'] / budget_ns * 100))
+    print("-" * 86)
+    if result.get('strip_mismatch') is not None:
+        print("{} strips, worst seam mismatch {:.4f}% of pixels".format(result['strips'], result['strip_mismatch'] * 100))
+    segments = result.get('segments')
+    if segments:
+        first = next(iter(segments.values()))['bytes_per_minute']
+        for segment_type, summary in segments.items():
+            print("{:<8} {:>8.2f} MB per minute in {} files ({:.1f}% of {})".format(
+                segment_type, summary['bytes_per_minute'] / 1e6, summary['files'],
+                summary['bytes_per_minute'] / first * 100, next(iter(segments))))
+
+def compare_to_baseline(report, baseline, tolerance):
+    regressions = []
+    for name, result in report['results'].items():
+        previous = baseline['results'].get(name)
+        if previous is None:
+            continue
+        for stage, summary in result['stages'].items():
+            before = previous['stages'].get(stage)
+            if before and before['p50'] and summary['p50'] > before['p50'] * (1 + tolerance):
+                regressions.append((name, stage, before['p50'], summary['p50']))
+    for name, stage, before, after in regressions:
+        print("REGRESSION {} {}: p50 {:.1f} us -> {:.1f} us".format(name, stage, before / 1e3, after / 1e3))
+    return regressions
+
+def parse_size(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Offline per-stage benchmark of the stream processor')
+    parser.add_argument('--resolutions', default='480p,720p,1080p,4k',
+                        help=f'comma separated, any of {", ".join(RESOLUTIONS)} or WIDTHxHEIGHT')
+    parser.add_argument('--frames', type=int, default=60, help='distinct frames per resolution')
+    parser.add_argument('--repeat', type=int, default=3, help='passes over the frames')
+    parser.add_argument('--fps', type=int, default=30, help='frame rate the budget column is measured against')
+    parser.add_argument('--input', default=None,
+                        help='raw gray frames recorded with ffmpeg -f rawvideo -pix_fmt gray, instead of synthetic ones')
+    parser.add_argument('--input-size', type=parse_size, default=(640, 480),
+                        help='WIDTHxHEIGHT of the frames in --input')
+    parser.add_argument('--pix-fmt', choices=PIXEL_FORMATS, default='yuv420p',
+                        help='format rendered for the encoder')
+    parser.add_argument('--strips', type=int, default=1,
+                        help='run Canny on this many horizontal strips in parallel, 0 picks by frame height')
+    parser.add_argument('--filters', default=None,
+                        help=f'time a filter graph instead of plain Canny, one of {", ".join(LOOKS)} or a JSON file')
+    parser.add_argument('--compare-dense', action='store_true',
+                        help='with --filters, also time every resolution with dense morphology kernels')
+    parser.add_argument('--ffmpeg', action='store_true',
+                        help='encode with libx264 into a null muxer instead of writing to /dev/null')
+    parser.add_argument('--segment-types', default=None,
+                        help=f'comma separated, any of {", ".join(SEGMENT_TYPES)}: also encode every resolution into '
+                             'HLS segments of each type at the same bitrate and report bytes per minute')
+    parser.add_argument('--output', default=None, help='write the results to this JSON file')
+    parser.add_argument('--baseline', default=None,
+                        help='earlier --output file to compare against, exits non-zero on a regression')
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help='allowed p50 slowdown per stage against --baseline')
+    args = parser.parse_args()
+    if args.segment_types and not set(args.segment_types.split(',')) <= set(SEGMENT_TYPES):
+        parser.error(f'--segment-types takes {", ".join(SEGMENT_TYPES)}')
+    return args
+
+def main():
+    args = parse_args()
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'machine': {
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'cpus': os.cpu_count(),
+            'opencv_threads': cv2.getNumThreads(),
+        },
+        'config': {
+            'frames': args.frames,
+            'repeat': args.repeat,
+            'fps': args.fps,
+            'input': args.input,
+            'ffmpeg': args.ffmpeg,
+            'pix_fmt': args.pix_fmt,
+            'strips': args.strips,
+            'filters': args.filters,
+            'segment_types': args.segment_types,
+        },
+        'results': {},
+    }
+    budget_ns = 1e9 / args.fps
+    for name in args.resolutions.split(','):
+        width, height = RESOLUTIONS.get(name) or parse_size(name)
+        if args.input:
+            frames = recorded_frames(args.input, args.input_size, width, height, args.frames)
+        else:
+            frames = synthetic_frames(width, height, args.frames)
+        result = benchmark_resolution(frames, args)
+        if args.segment_types:
+            result['segments'] = {segment_type: segment_bytes(frames, args, segment_type)
+                                  for segment_type in args.segment_types.split(',')}
+        report['results'][name] = result
+        print_results(name, result, budget_ns)
+        if args.filters and args.compare_dense:
+            result = benchmark_resolution(frames, args, decompose=False)
+            report['results'][f'{name}-dense'] = result
+            print_results(f'{name} dense morphology', result, budget_ns)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare_to_baseline(report, baseline, args.tolerance):
+            raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+LOW_THRESHOLD = 575
+HIGH_THRESHOLD = 600
+# (minimum frame height, strips) for StripEdgeDetector, tallest first
+STRIPS_BY_HEIGHT = ((2160, 8), (1080, 4), (720, 2))
+
+
+def detect_edges(frame, out=None, aperture_size=5, l2_gradient=True, low=LOW_THRESHOLD, high=HIGH_THRESHOLD):
+    # Writes into out when given so callers can keep one edge buffer per stage
+    return cv2.Canny(frame, low, high, edges=out, apertureSize=aperture_size, L2gradient=l2_gradient)
+
+
+class TiledEdgeDetector:
+    def __init__(self, width, height, tile_size=64, pixel_threshold=16, sensitivity=0.01, overlap=16,
+                 aperture_size=5, l2_gradient=True):
+        if tile_size < 8 or tile_size % 2:
+            raise ValueError(f'Tile size must be an even number of at least 8 pixels, got {tile_size}')
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        # A pixel counts as changed when it moved by more than pixel_threshold
+        # levels, a tile when more than sensitivity of its pixels changed
+        self.pixel_threshold = pixel_threshold
+        self.sensitivity = sensitivity
+        # Extra context around a tile so the 5x5 Sobel and hysteresis see
+        # past the tile border
+        self.overlap = overlap
+        self.options = {'aperture_size': aperture_size, 'l2_gradient': l2_gradient}
+        # Input each tile's cached edges were computed from, so slow drifts
+        # add up until the tile is recomputed
+        self.reference = np.empty((height, width), dtype=np.uint8)
+        self.edges = np.empty((height, width), dtype=np.uint8)
+        self.diff = np.empty((height, width), dtype=np.uint8)
+        self.tile_rows = np.append(np.arange(0, height, tile_size), height)
+        self.tile_cols = np.append(np.arange(0, width, tile_size), width)
+        tile_heights = np.diff(self.tile_rows)[:, np.newaxis]
+        tile_widths = np.diff(self.tile_cols)[np.newaxis, :]
+        self.min_changed = np.maximum(tile_heights * tile_widths * sensitivity, 1)
+        self.tile_count = (len(self.tile_rows) - 1) * (len(self.tile_cols) - 1)
+        self.primed = False
+        self.regions = None
+        self.recomputed = 1.0
+
+    def changed_tiles(self, frame):
+        cv2.absdiff(frame, self.reference, dst=self.diff)
+        cv2.threshold(self.diff, self.pixel_threshold, 1, cv2.THRESH_BINARY, dst=self.diff)
+        # Changed pixels per tile from the integral image at the tile corners
+        integral = cv2.integral(self.diff)
+        corners = integral[self.tile_rows][:, self.tile_cols]
+        counts = corners[1:, 1:] - corners[:-1, 1:] - corners[1:, :-1] + corners[:-1, :-1]
+        return np.argwhere(counts >= self.min_changed)
+
+    def merge_runs(self, changed):
+        # Neighbouring changed tiles in a row share one Canny call, which
+        # saves the call overhead and the overlap between them
+        run = None
+        for row, col in changed:
+            if run is not None and run[0] == row and run[2] == col:
+                run[2] = col + 1
+                continue
+            if run is not None:
+                yield self.tile_rect(*run)
+            run = [row, col, col + 1]
+        if run is not None:
+            yield self.tile_rect(*run)
+
+    def tile_rect(self, row, first_col, end_col):
+        return (int(self.tile_rows[row]), int(self.tile_rows[row + 1]),
+                int(self.tile_cols[first_col]), int(self.tile_cols[end_col]))
+
+    def reset(self):
+        # The next frame is detected in full, e.g. after a reconnect
+        self.primed = False
+
+    def detect(self, frame, out=None):
+        if not self.primed:
+            detect_edges(frame, out=self.edges, **self.options)
+            self.reference[:] = frame
+            self.primed = True
+            # None tells the renderer to draw the whole frame
+            self.regions = None
+            self.recomputed = 1.0
+        else:
+            changed = self.changed_tiles(frame)
+            self.regions = []
+            for y0, y1, x0, x1 in self.merge_runs(changed):
+                top, bottom = max(y0 - self.overlap, 0), min(y1 + self.overlap, self.height)
+                left, right = max(x0 - self.overlap, 0), min(x1 + self.overlap, self.width)
+                tile_edges = detect_edges(frame[top:bottom, left:right], **self.options)
+                self.edges[y0:y1, x0:x1] = tile_edges[y0 - top:y1 - top, x0 - left:x1 - left]
+                self.reference[y0:y1, x0:x1] = frame[y0:y1, x0:x1]
+                self.regions.append((y0, y1, x0, x1))
+            self.recomputed = len(changed) / self.tile_count
+        if out is not None:
+            out[:] = self.edges
+            return out
+        return self.edges
+
+
+def default_strips(height):
+    for min_height, strips in STRIPS_BY_HEIGHT:
+        if height >= min_height:
+            return strips
+    return 1
+
+
+class StripEdgeDetector:
+    def __init__(self, width, height, strips=None, overlap=16, verify_interval=0,
+                 aperture_size=5, l2_gradient=True, low=LOW_THRESHOLD, high=HIGH_THRESHOLD):
+        strips = min(strips or default_strips(height), height)
+        self.width = width
+        self.height = height
+        self.options = {'aperture_size': aperture_size, 'l2_gradient': l2_gradient, 'low': low, 'high': high}
+        # Each strip is detected with overlap rows of context on either side:
+        # the 5x5 Sobel needs 2, non-maximum suppression 1 more, and the rest
+        # lets hysteresis follow weak edges across the seam
+        bounds = np.linspace(0, height, strips + 1).astype(int)
+        self.strips = []
+        for top, bottom in zip(bounds[:-1], bounds[1:]):
+            start, end = max(top - overlap, 0), min(bottom + overlap, height)
+            self.strips.append((int(top), int(bottom), int(start), int(end)))
+        self.buffers = [np.empty((end - start, width), dtype=np.uint8) for _, _, start, end in self.strips]
+        self.edges = np.empty((height, width), dtype=np.uint8)
+        # Canny releases the GIL, so plain threads run the strips side by side.
+        # The caller's thread takes the first strip itself
+        self.executor = ThreadPoolExecutor(len(self.strips) - 1, thread_name_prefix='canny') if strips > 1 else None
+        # Every verify_interval frames the stitched mask is compared with a
+        # full frame Canny, mismatch is the share of pixels that differed
+        self.verify_interval = verify_interval
+        self.frames = 0
+        self.mismatch = None
+
+    def detect_strip(self, frame, out, index):
+        top, bottom, start, end = self.strips[index]
+        detect_edges(frame[start:end], out=self.buffers[index], **self.options)
+        out[top:bottom] = self.buffers[index][top - start:bottom - start]
+
+    def detect(self, frame, out=None):
+        if out is None:
+            out = self.edges
+        if self.executor is None:
+            detect_edges(frame, out=out, **self.options)
+        else:
+            futures = [self.executor.submit(self.detect_strip, frame, out, index)
+                       for index in range(1, len(self.strips))]
+            self.detect_strip(frame, out, 0)
+            for future in futures:
+                future.result()
+
+        self.frames += 1
+        if self.verify_interval and self.frames % self.verify_interval == 0:
+            self.mismatch = self.verify(frame, out)
+        else:
+            self.mismatch = None
+        return out
+
+    def verify(self, frame, edges):
+        full = detect_edges(frame, **self.options)
+        return np.count_nonzero(full != edges) / full.size
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
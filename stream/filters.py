@@ -0,0 +1,428 @@
+import collections
+import functools
+import json
+import time
+
+import cv2
+import numpy as np
+
+from edges import HIGH_THRESHOLD, LOW_THRESHOLD
+
+# What a stage reads or writes, the frame size comes from the graph
+Spec = collections.namedtuple('Spec', ['channels', 'dtype'])
+GRAY = Spec(1, np.uint8)
+BGR = Spec(3, np.uint8)
+
+
+# Most rectangles a kernel is split into before dense morphology is cheaper
+MAX_KERNEL_RECTANGLES = 4
+
+
+def kernel_key(kernel):
+    # Hashable form of a kernel config, so equal kernels share one cache entry
+    kernel = np.asarray(kernel)
+    if kernel.ndim == 1:
+        return tuple(int(size) for size in kernel)
+    return tuple(tuple(int(value) for value in row) for row in kernel)
+
+@functools.lru_cache(maxsize=None)
+def structuring_element(key):
+    # (w, h) is a rectangle of ones, rows of values are used as the kernel itself
+    if isinstance(key[0], int):
+        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, key)
+    else:
+        kernel = np.array(key, dtype=np.uint8)
+    # Shared between every stage built with the same parameters
+    kernel.flags.writeable = False
+    return kernel
+
+@functools.lru_cache(maxsize=None)
+def kernel_rectangles(key):
+    # Splits a kernel whose rows are each one run of ones into the rectangles
+    # formed by equal neighbouring rows, as (top, left, height, width). None
+    # when it would take too many, then dense morphology is used
+    kernel = structuring_element(key)
+    rectangles = []
+    for row, values in enumerate(kernel):
+        columns = np.flatnonzero(values)
+        if not len(columns):
+            continue
+        left, right = int(columns[0]), int(columns[-1]) + 1
+        if right - left != len(columns):
+            return None
+        previous = rectangles[-1] if rectangles else None
+        if previous and previous[0] + previous[2] == row and previous[1] == left and previous[3] == right - left:
+            rectangles[-1] = (previous[0], left, previous[2] + 1, right - left)
+        else:
+            rectangles.append((row, left, 1, right - left))
+    if not rectangles or len(rectangles) > MAX_KERNEL_RECTANGLES:
+        return None
+    return tuple(rectangles)
+
+@functools.lru_cache(maxsize=None)
+def gamma_table(gamma):
+    table = np.round((np.arange(256) / 255.0) ** (1.0 / gamma) * 255).astype(np.uint8)
+    table.flags.writeable = False
+    return table
+
+
+class Stage:
+    name = None
+    accepts = (GRAY,)
+
+    def output_spec(self, spec):
+        # Most stages keep the format they were given
+        return spec
+
+    def apply(self, src, dst):
+        raise NotImplementedError
+
+    def fuse(self, following):
+        # A stage that can do its own work and following's in one pass
+        # returns the combined stage, otherwise None
+        return None
+
+
+class GaussianBlur(Stage):
+    name = 'gaussian_blur'
+    accepts = (GRAY, BGR)
+
+    def __init__(self, ksize=15, sigma=0):
+        self.ksize = (ksize, ksize) if isinstance(ksize, int) else tuple(ksize)
+        self.sigma = sigma
+
+    def apply(self, src, dst):
+        cv2.GaussianBlur(src, self.ksize, self.sigma, dst=dst)
+
+
+class Gray(Stage):
+    name = 'gray'
+    accepts = (BGR,)
+
+    def output_spec(self, spec):
+        return GRAY
+
+    def apply(self, src, dst):
+        cv2.cvtColor(src, cv2.COLOR_BGR2GRAY, dst=dst)
+
+
+class Lut(Stage):
+    name = 'lut'
+    accepts = (GRAY, BGR)
+
+    def __init__(self, table):
+        self.table = np.asarray(table, dtype=np.uint8)
+
+    def apply(self, src, dst):
+        cv2.LUT(src, self.table, dst=dst)
+
+    def fuse(self, following):
+        # Two lookups are one lookup through the composed table
+        if isinstance(following, Lut):
+            return Lut(following.table[self.table])
+        return None
+
+
+class Gamma(Lut):
+    name = 'gamma'
+
+    def __init__(self, gamma=0.5):
+        super().__init__(gamma_table(gamma))
+
+
+class Canny(Stage):
+    name = 'canny'
+
+    def __init__(self, low=LOW_THRESHOLD, high=HIGH_THRESHOLD, aperture_size=5, l2_gradient=True):
+        self.low = low
+        self.high = high
+        self.aperture_size = aperture_size
+        self.l2_gradient = l2_gradient
+
+    def apply(self, src, dst):
+        cv2.Canny(src, self.low, self.high, edges=dst, apertureSize=self.aperture_size, L2gradient=self.l2_gradient)
+
+
+class Morphology(Stage):
+    name = 'morphology'
+    accepts = (GRAY, BGR)
+    operations = {
+        'dilate': cv2.MORPH_DILATE,
+        'erode': cv2.MORPH_ERODE,
+        'open': cv2.MORPH_OPEN,
+        'close': cv2.MORPH_CLOSE,
+    }
+    # The passes open and close are made of
+    steps = {
+        'dilate': ('dilate',),
+        'erode': ('erode',),
+        'open': ('erode', 'dilate'),
+        'close': ('dilate', 'erode'),
+    }
+
+    def __init__(self, operation, kernel=(3, 3), iterations=1, decompose=True):
+        if operation not in self.operations:
+            raise ValueError(f'Unknown morphology operation: {operation}')
+        self.operation = operation
+        self.key = kernel_key(kernel)
+        self.kernel = structuring_element(self.key)
+        self.iterations = iterations
+        self.decompose = decompose
+        # A full rectangle already runs as a row pass and a column pass inside
+        # OpenCV, so only kernels that split into a few rectangles take the
+        # decomposed path
+        rectangles = kernel_rectangles(self.key) if decompose else None
+        self.rectangles = rectangles if rectangles is not None and len(rectangles) > 1 else None
+        self.buffers = {}
+
+    def buffer(self, name, shape):
+        # Allocated on the first frame of each size, then reused
+        key = (name, shape)
+        if key not in self.buffers:
+            self.buffers[key] = np.empty(shape, dtype=np.uint8)
+        return self.buffers[key]
+
+    def apply(self, src, dst):
+        if self.rectangles is None:
+            cv2.morphologyEx(src, self.operations[self.operation], self.kernel, dst=dst, iterations=self.iterations)
+            return
+        steps = self.steps[self.operation] * self.iterations
+        for index, step in enumerate(steps):
+            source = src if index == 0 else dst
+            self.apply_rectangles(step, source, dst)
+
+    def apply_rectangles(self, step, src, dst):
+        # Dilating by a union of rectangles is the max of dilating by each
+        # (min for erode). The source is padded by the kernel so every
+        # rectangle is applied with its corner as anchor and then cropped
+        # back into place, which matches the dense result up to the border
+        kernel_height, kernel_width = self.kernel.shape
+        anchor_y, anchor_x = kernel_height // 2, kernel_width // 2
+        height, width = src.shape[:2]
+        neutral = 0 if step == 'dilate' else 255
+        padded_shape = (height + kernel_height - 1, width + kernel_width - 1) + src.shape[2:]
+        padded = self.buffer('padded', padded_shape)
+        cv2.copyMakeBorder(src, anchor_y, kernel_height - 1 - anchor_y, anchor_x, kernel_width - 1 - anchor_x,
+                           cv2.BORDER_CONSTANT, dst=padded, value=(neutral,) * 4)
+        passed = self.buffer('passed', padded_shape)
+        morph = cv2.dilate if step == 'dilate' else cv2.erode
+        combine = np.maximum if step == 'dilate' else np.minimum
+        for index, (top, left, rect_height, rect_width) in enumerate(self.rectangles):
+            rectangle = structuring_element((rect_width, rect_height))
+            morph(padded, rectangle, dst=passed, anchor=(0, 0), borderType=cv2.BORDER_CONSTANT,
+                  borderValue=(neutral,) * 4)
+            placed = passed[top:top + height, left:left + width]
+            if index == 0:
+                dst[:] = placed
+            else:
+                combine(dst, placed, out=dst)
+
+    def fuse(self, following):
+        # Dilate then erode with the same kernel is a close, erode then dilate
+        # an open, and morphologyEx runs those without a buffer in between
+        if not isinstance(following, Morphology) or self.iterations != 1 or following.iterations != 1:
+            return None
+        if self.key != following.key or self.decompose != following.decompose:
+            return None
+        pair = (self.operation, following.operation)
+        if pair == ('dilate', 'erode'):
+            return Close(self.key, decompose=self.decompose)
+        if pair == ('erode', 'dilate'):
+            return Open(self.key, decompose=self.decompose)
+        return None
+
+
+class Dilate(Morphology):
+    name = 'dilate'
+
+    def __init__(self, kernel=(3, 3), iterations=1, decompose=True):
+        super().__init__('dilate', kernel, iterations, decompose)
+
+
+class Erode(Morphology):
+    name = 'erode'
+
+    def __init__(self, kernel=(3, 3), iterations=1, decompose=True):
+        super().__init__('erode', kernel, iterations, decompose)
+
+
+class Close(Morphology):
+    name = 'close'
+
+    def __init__(self, kernel=(3, 3), iterations=1, decompose=True):
+        super().__init__('close', kernel, iterations, decompose)
+
+
+class Open(Morphology):
+    name = 'open'
+
+    def __init__(self, kernel=(3, 3), iterations=1, decompose=True):
+        super().__init__('open', kernel, iterations, decompose)
+
+
+class ContourSmooth(Stage):
+    name = 'contour_smooth'
+    approximations = {
+        'none': cv2.CHAIN_APPROX_NONE,
+        'simple': cv2.CHAIN_APPROX_SIMPLE,
+    }
+
+    def __init__(self, window=5, min_length=10, thickness=1, approximation='none'):
+        if window < 1 or window % 2 == 0:
+            raise ValueError(f'Smoothing window must be a positive odd number of points, got {window}')
+        if approximation not in self.approximations:
+            raise ValueError(f'Unknown contour approximation: {approximation}')
+        self.radius = window // 2
+        self.min_length = min_length
+        self.thickness = thickness
+        self.approximation = self.approximations[approximation]
+
+    def smooth(self, contours):
+        # Every kept contour goes into one flat (N, 2) array, with offsets
+        # marking where each starts, so the moving average runs once over the
+        # whole batch instead of once per contour
+        lengths = np.fromiter((len(contour) for contour in contours), dtype=np.intp, count=len(contours))
+        kept = np.flatnonzero(lengths >= self.min_length)
+        if not len(kept):
+            return []
+        lengths = lengths[kept]
+        points = np.concatenate([contours[index] for index in kept]).reshape(-1, 2).astype(np.float32)
+        offsets = np.zeros(len(lengths) + 1, dtype=np.intp)
+        np.cumsum(lengths, out=offsets[1:])
+
+        # Box filter from a running sum. RETR_EXTERNAL contours are closed
+        # loops, so each window wraps around within its own contour, and
+        # neighbouring contours never bleed into each other
+        window = 2 * self.radius + 1
+        sums = np.zeros((len(points) + 1, 2), dtype=np.float64)
+        np.cumsum(points, axis=0, out=sums[1:])
+        starts = np.repeat(offsets[:-1], lengths)
+        sizes = np.repeat(lengths, lengths)
+        # A window longer than its contour covers every point laps times
+        laps, rest = np.divmod(window, sizes)
+        low = (np.arange(len(points)) - starts - self.radius) % sizes
+        high = low + rest
+        wrapped = np.maximum(high - sizes, 0)
+        totals = laps[:, np.newaxis] * (sums[starts + sizes] - sums[starts])
+        totals += sums[starts + np.minimum(high, sizes)] - sums[starts + low]
+        totals += sums[starts + wrapped] - sums[starts]
+        smoothed = totals / window
+        smoothed = np.rint(smoothed).astype(np.int32)
+        bounds = offsets.tolist()
+        return [smoothed[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+    def apply(self, src, dst):
+        contours, _ = cv2.findContours(src, cv2.RETR_EXTERNAL, self.approximation)
+        dst[:] = 0
+        smoothed = self.smooth(contours)
+        if smoothed:
+            # One call draws every contour
+            cv2.polylines(dst, smoothed, True, 255, self.thickness)
+
+
+STAGES = {stage.name: stage for stage in (GaussianBlur, Gray, Lut, Gamma, Canny, Morphology, Dilate, Erode, Close, Open,
+                                          ContourSmooth)}
+
+# Named looks, from the styling experiments in research/
+LOOKS = {
+    'canny': [{'stage': 'canny'}],
+    # research/tt.py
+    'soft': [
+        {'stage': 'gaussian_blur', 'ksize': 15},
+        {'stage': 'canny', 'low': 300, 'high': 400, 'l2_gradient': False},
+        {'stage': 'close', 'kernel': [2, 2]},
+    ],
+    # research/styling/dilation_eroding.py, thresholded into lines by Canny
+    'gamma_morph': [
+        {'stage': 'gamma', 'gamma': 0.5},
+        {'stage': 'dilate', 'kernel': [[0] * 4 + [1] * 8] * 4 + [[1] * 12] * 8},
+        {'stage': 'erode', 'kernel': [12, 12]},
+        {'stage': 'canny'},
+    ],
+    # research/og_frame_changes.py
+    'contours': [
+        {'stage': 'canny', 'low': 400, 'high': 450, 'l2_gradient': False},
+        {'stage': 'contour_smooth', 'window': 5, 'min_length': 10, 'approximation': 'simple'},
+    ],
+}
+
+
+def build_stage(config):
+    options = dict(config)
+    name = options.pop('stage')
+    if name not in STAGES:
+        raise ValueError(f'Unknown filter stage: {name}')
+    return STAGES[name](**options)
+
+
+class FilterGraph:
+    def __init__(self, stages, width, height, input_spec=GRAY):
+        self.width = width
+        self.height = height
+        self.stages = self.fuse(list(stages))
+        if not self.stages:
+            raise ValueError('A filter graph needs at least one stage')
+        # Check every stage accepts what the one before makes, and allocate
+        # its output once for all frames
+        self.buffers = []
+        self.names = []
+        spec = input_spec
+        for stage in self.stages:
+            if spec not in stage.accepts:
+                raise ValueError(f'{stage.name} cannot take {spec.channels} channel {np.dtype(spec.dtype).name} frames')
+            spec = stage.output_spec(spec)
+            shape = (height, width) if spec.channels == 1 else (height, width, spec.channels)
+            self.buffers.append(np.empty(shape, dtype=spec.dtype))
+            self.names.append(self.unique_name(stage.name))
+        if spec != GRAY:
+            raise ValueError('A filter graph must end in a gray uint8 mask for the renderer')
+        self.times = {}
+
+    @staticmethod
+    def fuse(stages):
+        fused = []
+        for stage in stages:
+            combined = fused[-1].fuse(stage) if fused else None
+            if combined is None:
+                fused.append(stage)
+            else:
+                fused[-1] = combined
+        return fused
+
+    def unique_name(self, name):
+        # Repeated stages are timed as blur, blur.2, ...
+        count = sum(1 for existing in self.names if existing.split('.')[0] == name)
+        return name if not count else f'{name}.{count + 1}'
+
+    def run(self, frame, out=None):
+        src = frame
+        last = len(self.stages) - 1
+        for index, (stage, name) in enumerate(zip(self.stages, self.names)):
+            dst = out if index == last and out is not None else self.buffers[index]
+            start = time.perf_counter_ns()
+            stage.apply(src, dst)
+            self.times[name] = time.perf_counter_ns() - start
+            src = dst
+        return src
+
+
+def resolve_filters(filters):
+    # A look name, a JSON file holding a list of stages, or the list itself
+    if filters is None or isinstance(filters, list):
+        return filters
+    if filters in LOOKS:
+        return LOOKS[filters]
+    if filters.endswith('.json'):
+        with open(filters) as f:
+            return json.load(f)
+    raise ValueError(f'Unknown look: {filters}')
+
+def build_graph(filters, width, height, decompose=True):
+    config = resolve_filters(filters)
+    if config is None:
+        return None
+    if not decompose:
+        # Dense morphology everywhere, for comparing against the decomposed path
+        config = [dict(stage, decompose=False) if issubclass(STAGES[stage['stage']], Morphology) else stage
+                  for stage in config]
+    return FilterGraph([build_stage(stage) for stage in config], width, height)
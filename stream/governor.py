@@ -0,0 +1,90 @@
+import collections
+
+import cv2
+import numpy as np
+
+from edges import HIGH_THRESHOLD, LOW_THRESHOLD, detect_edges
+
+
+def default_ladder(width, height):
+    # Cheapest last. A 3x3 Sobel responds about 12x weaker than the 5x5 one,
+    # so its thresholds are scaled down to keep a similar amount of lines, and
+    # the L1 norm reads a little higher than L2
+    return [
+        {'width': width, 'height': height, 'aperture_size': 5, 'l2_gradient': True,
+         'low': LOW_THRESHOLD, 'high': HIGH_THRESHOLD},
+        {'width': width, 'height': height, 'aperture_size': 3, 'l2_gradient': True, 'low': 48, 'high': 50},
+        {'width': width * 3 // 4, 'height': height * 3 // 4, 'aperture_size': 3, 'l2_gradient': False,
+         'low': 56, 'high': 60},
+        {'width': width // 2, 'height': height // 2, 'aperture_size': 3, 'l2_gradient': False,
+         'low': 56, 'high': 60},
+    ]
+
+
+class QualityGovernor:
+    def __init__(self, width, height, fps, ladder=None, high_water=0.8, low_water=0.5, window=30, cooldown=90,
+                 name=None):
+        self.width = width
+        self.height = height
+        self.ladder = ladder or default_ladder(width, height)
+        self.budget_ns = 1e9 / fps
+        self.high_water = high_water
+        self.low_water = low_water
+        self.cooldown = cooldown
+        self.name = name
+        self.samples = collections.deque(maxlen=window)
+        self.frames_at_level = 0
+        self.level = 0
+        # Edge buffers at each ladder size, plus the full size mask handed on
+        self.buffers = {}
+        self.edges = np.empty((height, width), dtype=np.uint8)
+
+    def buffers_for(self, setting):
+        size = (setting['height'], setting['width'])
+        if size not in self.buffers:
+            self.buffers[size] = (np.empty(size, dtype=np.uint8), np.empty(size, dtype=np.uint8))
+        return self.buffers[size]
+
+    def detect(self, frame, out=None):
+        setting = self.ladder[self.level]
+        if out is None:
+            out = self.edges
+        options = {key: setting[key] for key in ('aperture_size', 'l2_gradient', 'low', 'high')}
+        if (setting['height'], setting['width']) == frame.shape:
+            return detect_edges(frame, out=out, **options)
+        small, small_edges = self.buffers_for(setting)
+        cv2.resize(frame, (setting['width'], setting['height']), dst=small, interpolation=cv2.INTER_AREA)
+        detect_edges(small, out=small_edges, **options)
+        # Scale the mask back up so the encoder always gets the stream size
+        cv2.resize(small_edges, (self.width, self.height), dst=out, interpolation=cv2.INTER_NEAREST)
+        return out
+
+    def pixels(self, level):
+        return self.ladder[level]['width'] * self.ladder[level]['height']
+
+    def observe(self, processing_ns):
+        self.samples.append(processing_ns)
+        self.frames_at_level += 1
+        if len(self.samples) < self.samples.maxlen or self.frames_at_level < self.cooldown:
+            return False
+        average = sum(self.samples) / len(self.samples)
+        level = self.level
+        if average > self.high_water * self.budget_ns and level < len(self.ladder) - 1:
+            level += 1
+        elif level > 0:
+            # Only step up when the better level, scaled by its pixel count,
+            # would still sit under the low water mark
+            projected = average * self.pixels(level - 1) / self.pixels(level)
+            if projected < self.low_water * self.budget_ns:
+                level -= 1
+        if level == self.level:
+            return False
+        self.level = level
+        self.samples.clear()
+        self.frames_at_level = 0
+        setting = self.ladder[level]
+        prefix = f'[{self.name}] ' if self.name else ''
+        print(f'{prefix}Quality level {level}: {setting["width"]}x{setting["height"]}, '
+              f'aperture {setting["aperture_size"]}, L2 {setting["l2_gradient"]} '
+              f'(average {average / 1e6:.2f} ms of {self.budget_ns / 1e6:.2f} ms)')
+        return True
@@ -0,0 +1,37 @@
+import numpy as np
+
+# Upper bound on the Python-side read buffer for one input pipe, so several
+# cameras on one box can't each pin 100 MB like the old bufsize=10**8 did
+MAX_READ_BUFFER = 32 * 1024 * 1024
+
+
+def read_buffer_size(frame_size, frames=1):
+    # 0 frames means unbuffered: readinto then goes straight to the pipe
+    return min(frame_size * frames, MAX_READ_BUFFER)
+
+
+def read_frame_into(stream, buffer):
+    view = memoryview(buffer).cast('B')
+    filled = 0
+    # Pipes hand back at most what ffmpeg has flushed, so keep reading until
+    # the frame is complete
+    while filled < len(view):
+        count = stream.readinto(view[filled:])
+        if not count:
+            raise EOFError(f'Input stream ended after {filled} of {len(view)} bytes')
+        filled += count
+    return filled
+
+
+class FramePool:
+    def __init__(self, count, width, height):
+        self.shape = (height, width)
+        self.buffers = [bytearray(width * height) for _ in range(count)]
+        self.frames = [np.frombuffer(buffer, dtype=np.uint8).reshape((height, width)) for buffer in self.buffers]
+        self.next = 0
+
+    def take(self):
+        # Round robin, so a frame stays valid until the pool wraps around
+        frame = self.frames[self.next]
+        self.next = (self.next + 1) % len(self.frames)
+        return frame
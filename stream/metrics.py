@@ -0,0 +1,142 @@
+import time
+
+# 2**6 sub-buckets per power of two keeps every bucket within ~3% of its value
+SUB_BUCKET_BITS = 6
+HALF_BUCKET_COUNT = 1 << (SUB_BUCKET_BITS - 1)
+# Anything slower than ~18 minutes lands in the last bucket
+HIGHEST_TRACKABLE_NS = (1 << 40) - 1
+
+
+def bucket_index(value):
+    magnitude = value.bit_length() - SUB_BUCKET_BITS
+    if magnitude <= 0:
+        return value
+    return (magnitude << (SUB_BUCKET_BITS - 1)) + (value >> magnitude)
+
+def bucket_range(index):
+    if index < 2 * HALF_BUCKET_COUNT:
+        return index, 1
+    magnitude = (index >> (SUB_BUCKET_BITS - 1)) - 1
+    mantissa = index - (magnitude << (SUB_BUCKET_BITS - 1))
+    return mantissa << magnitude, 1 << magnitude
+
+
+class LatencyHistogram:
+    def __init__(self):
+        # Log-linear buckets in the style of HdrHistogram: fixed memory no
+        # matter how many values are recorded
+        self.counts = [0] * (bucket_index(HIGHEST_TRACKABLE_NS) + 1)
+        self.reset()
+
+    def reset(self):
+        for i in range(len(self.counts)):
+            self.counts[i] = 0
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value_ns):
+        value_ns = min(max(int(value_ns), 0), HIGHEST_TRACKABLE_NS)
+        self.counts[bucket_index(value_ns)] += 1
+        self.count += 1
+        self.total += value_ns
+        if value_ns > self.max:
+            self.max = value_ns
+
+    def percentile(self, percent):
+        if not self.count:
+            return 0
+        target = max(1, round(self.count * percent / 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                low, width = bucket_range(index)
+                # Middle of the bucket, but never past the largest real value
+                return min(low + width // 2, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+
+class FrameMetrics:
+    def __init__(self, fps, window=5.0):
+        self.frame_budget_ns = 1e9 / fps
+        self.window_ns = int(window * 1e9)
+        self.histograms = {}
+        # Per-frame fractions such as the share of tiles recomputed, kept as
+        # [total, count, max] per name
+        self.gauges = {}
+        self.frames = 0
+        self.dropped = 0
+        self.duplicated = 0
+        self.window_start = time.perf_counter_ns()
+
+    def record(self, times, gauges=None):
+        # times maps stage name -> duration in nanoseconds
+        for stage, value in times.items():
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = LatencyHistogram()
+            histogram.record(value)
+        for name, value in (gauges or {}).items():
+            gauge = self.gauges.setdefault(name, [0.0, 0, 0.0])
+            gauge[0] += value
+            gauge[1] += 1
+            gauge[2] = max(gauge[2], value)
+        self.frames += 1
+
+    def drop(self, count=1):
+        self.dropped += count
+
+    def duplicate(self, count=1):
+        self.duplicated += count
+
+    def due(self):
+        return time.perf_counter_ns() - self.window_start >= self.window_ns
+
+    def report(self):
+        now = time.perf_counter_ns()
+        elapsed = (now - self.window_start) / 1e9
+        report = {
+            'elapsed': elapsed,
+            'frames': self.frames,
+            'dropped': self.dropped,
+            'duplicated': self.duplicated,
+            'fps': self.frames / elapsed if elapsed else 0.0,
+            'frame_budget_ns': self.frame_budget_ns,
+            'stages': {stage: histogram.summary() for stage, histogram in self.histograms.items()},
+            'gauges': {name: {'mean': total / count, 'max': peak}
+                       for name, (total, count, peak) in self.gauges.items() if count},
+        }
+        for histogram in self.histograms.values():
+            histogram.reset()
+        self.gauges.clear()
+        self.frames = 0
+        self.dropped = 0
+        self.duplicated = 0
+        self.window_start = now
+        return report
+
+
+def print_report(report):
+    print("\n{:<20} {:>12} {:>12} {:>12} {:>12} {:>16}".format(
+        "Operation", "p50 (us)", "p90 (us)", "p99 (us)", "max (us)", "p99 % of Budget"))
+    print("-" * 90)
+    for stage, summary in report['stages'].items():
+        print("{:<20} {:>12.1f} {:>12.1f} {:>12.1f} {:>12.1f} {:>15.2f}%".format(
+            stage, summary['p50'] / 1e3, summary['p90'] / 1e3, summary['p99'] / 1e3, summary['max'] / 1e3,
+            summary['p99'] / report['frame_budget_ns'] * 100))
+    print("-" * 90)
+    print("{:.2f} fps over {:.1f}s, {} frames, {} dropped, {} duplicated".format(
+        report['fps'], report['elapsed'], report['frames'], report['dropped'], report['duplicated']))
+    for name, gauge in report.get('gauges', {}).items():
+        print("{}: mean {:.1f}%, max {:.1f}%".format(name, gauge['mean'] * 100, gauge['max'] * 100))
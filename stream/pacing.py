@@ -0,0 +1,38 @@
+import time
+
+# Past this much backlog the writer stops catching up and restarts the clock
+MAX_CATCH_UP_NS = 1_000_000_000
+
+
+class FramePacer:
+    def __init__(self, fps, clock=time.perf_counter_ns):
+        self.interval = int(1e9 / fps)
+        self.clock = clock
+        self.next_deadline = None
+        self.dropped = 0
+        self.duplicated = 0
+        self.resyncs = 0
+
+    def start(self):
+        self.next_deadline = self.clock() + self.interval
+
+    def remaining(self):
+        # Nanoseconds until the next output frame is due, never negative
+        return max(self.next_deadline - self.clock(), 0)
+
+    def wait(self):
+        remaining = self.remaining()
+        if remaining:
+            time.sleep(remaining / 1e9)
+
+    def is_late(self, timestamp):
+        # A frame that sat in the queue for over a frame interval would only
+        # be shown late, so processing it just delays the fresher ones
+        return self.clock() - timestamp > self.interval
+
+    def advance(self):
+        self.next_deadline += self.interval
+        now = self.clock()
+        if now - self.next_deadline > MAX_CATCH_UP_NS:
+            self.next_deadline = now + self.interval
+            self.resyncs += 1
@@ -0,0 +1,208 @@
+import collections
+import multiprocessing
+import queue
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from edges import detect_edges
+from filters import build_graph
+from ingest import read_frame_into
+from render import Renderer, frame_shape
+
+
+class SharedFrames:
+    def __init__(self, count, width, height, pix_fmt, name=None):
+        input_size = width * height
+        output_shape = frame_shape(width, height, pix_fmt)
+        output_size = int(np.prod(output_shape))
+        if name is None:
+            self.memory = shared_memory.SharedMemory(create=True, size=count * (input_size + output_size))
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        # Slot i is a gray input frame and the encoder frame rendered from it
+        self.inputs = np.ndarray((count, height, width), dtype=np.uint8, buffer=self.memory.buf)
+        self.outputs = np.ndarray((count,) + output_shape, dtype=np.uint8, buffer=self.memory.buf,
+                                  offset=count * input_size)
+
+    def close(self):
+        # The views pin the mapping, drop them before closing it
+        del self.inputs, self.outputs
+        self.memory.close()
+
+
+def worker_main(name, count, width, height, pix_fmt, tasks, results, filters=None):
+    frames = SharedFrames(count, width, height, pix_fmt, name=name)
+    renderer = Renderer(width, height, pix_fmt)
+    edges = np.empty((height, width), dtype=np.uint8)
+    # Each worker builds its own graph from the config, buffers and all
+    graph = build_graph(filters, width, height)
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            index, slot, background_color, line_color = task
+            times = {}
+
+            start = time.perf_counter_ns()
+            if graph is None:
+                detect_edges(frames.inputs[slot], out=edges)
+            else:
+                graph.run(frames.inputs[slot], out=edges)
+                for stage, value in graph.times.items():
+                    times[f'filter.{stage}'] = value
+            times['edges'] = time.perf_counter_ns() - start
+
+            start = time.perf_counter_ns()
+            renderer.render(edges, background_color, line_color, out=frames.outputs[slot])
+            times['colorize'] = time.perf_counter_ns() - start
+
+            results.put((index, slot, times))
+    finally:
+        frames.close()
+
+
+class FrameProcessPool:
+    def __init__(self, width, height, workers, max_in_flight, pix_fmt, filters=None):
+        self.width = width
+        self.height = height
+        self.shape = (height, width)
+        self.pix_fmt = pix_fmt
+        self.filters = filters
+        self.max_in_flight = max_in_flight
+        self.frames = SharedFrames(max_in_flight, width, height, pix_fmt)
+        self.tasks = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.workers = [
+            multiprocessing.Process(target=worker_main, daemon=True,
+                                    args=(self.frames.memory.name, max_in_flight, width, height, pix_fmt,
+                                          self.tasks, self.results, filters))
+            for _ in range(workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+        self.free_slots = collections.deque(range(max_in_flight))
+        # Reorder buffer: frames finish out of order but must be encoded in order
+        self.finished = {}
+        self.in_flight = 0
+        # Shared with every other stream of a registry, one slot per frame in
+        # the workers
+        self.compute_slots = None
+
+    def alive(self):
+        return all(worker.is_alive() for worker in self.workers)
+
+    def wait_result(self):
+        while True:
+            try:
+                return self.results.get(timeout=1)
+            except queue.Empty:
+                if not self.alive():
+                    raise RuntimeError('Frame worker process died')
+
+    def take_compute_slot(self):
+        # Only block on a slot while none of this stream's frames are in the
+        # workers. Otherwise collect a result first, so two streams never wait
+        # on slots the other one holds
+        if self.compute_slots is None:
+            return True
+        return self.compute_slots.acquire(blocking=not self.in_flight)
+
+    def release_compute_slot(self):
+        if self.compute_slots is not None:
+            self.compute_slots.release()
+
+    def drop_in_flight(self):
+        # Frames a dead worker held never finish, give their slots back
+        # instead of waiting for them
+        while self.in_flight:
+            self.in_flight -= 1
+            self.release_compute_slot()
+
+    def reset(self):
+        # Collect frames still in the workers after the last stream broke
+        while self.in_flight and self.alive():
+            self.wait_result()
+            self.in_flight -= 1
+            self.release_compute_slot()
+        self.drop_in_flight()
+        self.finished.clear()
+        self.free_slots = collections.deque(range(self.max_in_flight))
+
+    def run(self, input_process, output_process, schedule, on_frame=None, compute_slots=None):
+        self.reset()
+        self.compute_slots = compute_slots
+        read_times = {}
+        next_index = 0
+        next_output = 0
+        ended = None
+        while True:
+            while self.free_slots and ended is None:
+                if not self.take_compute_slot():
+                    break
+                slot = self.free_slots.popleft()
+                start = time.perf_counter_ns()
+                try:
+                    read_frame_into(input_process.stdout, self.frames.inputs[slot])
+                except EOFError as e:
+                    # Still encode the frames the workers already have
+                    self.free_slots.append(slot)
+                    self.release_compute_slot()
+                    ended = e
+                    break
+                except BaseException:
+                    self.free_slots.append(slot)
+                    self.release_compute_slot()
+                    raise
+                read_time = time.perf_counter_ns() - start
+
+                start = time.perf_counter_ns()
+                background_color, line_color = schedule.colors()
+                read_times[next_index] = (read_time, time.perf_counter_ns() - start)
+
+                self.tasks.put((next_index, slot, tuple(background_color), tuple(line_color)))
+                self.in_flight += 1
+                next_index += 1
+
+            if not self.in_flight:
+                raise ended
+            index, slot, times = self.wait_result()
+            self.in_flight -= 1
+            self.release_compute_slot()
+            self.finished[index] = (slot, times)
+
+            while next_output in self.finished:
+                slot, times = self.finished.pop(next_output)
+                start = time.perf_counter_ns()
+                output_process.stdin.write(self.frames.outputs[slot].data)
+                times['send_output'] = time.perf_counter_ns() - start
+                times['get_frame'], times['get_colors'] = read_times.pop(next_output)
+                times['total'] = sum(times.values())
+                self.free_slots.append(slot)
+                next_output += 1
+                if on_frame is not None:
+                    on_frame(times, {})
+
+    def close(self):
+        self.drop_in_flight()
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        self.frames.close()
+        self.frames.memory.unlink()
+
+
+def ensure_process_pool(pool, width, height, workers, max_in_flight, pix_fmt, filters=None):
+    # A pool that lost a worker is replaced, the frames that worker held would
+    # never come back
+    if (pool is not None and pool.shape == (height, width) and pool.pix_fmt == pix_fmt and pool.filters == filters
+            and pool.alive()):
+        return pool
+    if pool is not None:
+        pool.close()
+    return FrameProcessPool(width, height, workers, max_in_flight, pix_fmt, filters)
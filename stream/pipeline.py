@@ -0,0 +1,267 @@
+import collections
+import contextlib
+import queue
+import threading
+import time
+
+import numpy as np
+
+from edges import detect_edges
+from ingest import read_frame_into
+from pacing import FramePacer
+from render import frame_shape
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+DROP_POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST)
+
+
+class FrameSlot:
+    def __init__(self, shape):
+        self.data = np.empty(shape, dtype=np.uint8)
+        self.index = 0
+        self.timestamp = 0
+
+
+class FrameQueue:
+    def __init__(self, capacity, shape, policy=BLOCK, on_drop=None, held=2):
+        if policy not in DROP_POLICIES:
+            raise ValueError(f'Unknown drop policy: {policy}')
+        self.capacity = capacity
+        self.policy = policy
+        # Extra slots for the producer and the consumer to hold
+        self.free = collections.deque(FrameSlot(shape) for _ in range(capacity + held))
+        self.ready = collections.deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+        self.on_drop = on_drop
+
+    def acquire(self):
+        # Producer side: an empty slot to fill, None once the queue is closed
+        with self.condition:
+            while not self.free and not self.closed:
+                self.condition.wait()
+            if self.closed:
+                return None
+            return self.free.popleft()
+
+    def publish(self, slot):
+        with self.condition:
+            while len(self.ready) >= self.capacity and not self.closed:
+                if self.policy == DROP_NEWEST:
+                    self.free.append(slot)
+                    self.record_drop()
+                    self.condition.notify_all()
+                    return
+                if self.policy == DROP_OLDEST:
+                    self.free.append(self.ready.popleft())
+                    self.record_drop()
+                    break
+                self.condition.wait()
+            if self.closed:
+                self.free.append(slot)
+                return
+            self.ready.append(slot)
+            self.condition.notify_all()
+
+    def record_drop(self):
+        self.dropped += 1
+        if self.on_drop is not None:
+            self.on_drop(1)
+
+    def get(self, timeout=None):
+        # Consumer side: the oldest filled slot, None once closed and drained,
+        # queue.Empty if nothing arrived within timeout seconds
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.ready or self.closed, timeout):
+                raise queue.Empty
+            if not self.ready:
+                return None
+            return self.ready.popleft()
+
+    def release(self, slot):
+        with self.condition:
+            self.free.append(slot)
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class Pipeline:
+    def __init__(self, input_process, output_process, renderer, schedule, width, height,
+                 queue_size=4, input_policy=DROP_OLDEST, output_policy=BLOCK, on_frame=None,
+                 on_drop=None, on_duplicate=None, compute_slots=None, fps=None, governor=None,
+                 tiles=None, strips=None, graph=None):
+        self.input_process = input_process
+        self.output_process = output_process
+        self.renderer = renderer
+        self.schedule = schedule
+        self.width = width
+        self.height = height
+        self.on_frame = on_frame
+        self.on_drop = on_drop
+        self.on_duplicate = on_duplicate
+        # With an fps the writer runs on a wall clock instead of as fast as
+        # frames arrive
+        self.pacer = FramePacer(fps) if fps else None
+        self.governor = governor
+        # Tiled detection reruns Canny only where the input changed
+        self.tiles = tiles
+        # Or splits Canny into strips over a thread pool
+        self.strips = strips
+        # Or a configured filter graph replaces plain Canny
+        self.graph = graph
+        # Shared between streams so they don't all run Canny at once
+        self.compute_slots = compute_slots or contextlib.nullcontext()
+        self.input_queue = FrameQueue(queue_size, (height, width), input_policy, on_drop)
+        # The paced writer keeps its last frame checked out to repeat it
+        self.output_queue = FrameQueue(queue_size, frame_shape(width, height, renderer.pix_fmt), output_policy, on_drop,
+                                       held=3 if self.pacer else 2)
+        self.stopped = threading.Event()
+        self.error = None
+
+    def stop(self, error=None):
+        if error is not None and self.error is None:
+            self.error = error
+        self.input_queue.close()
+        self.output_queue.close()
+        self.stopped.set()
+
+    def run_stage(self, target, downstream):
+        try:
+            target()
+        except EOFError as e:
+            # End of input: let the later stages drain what is already queued
+            if self.error is None:
+                self.error = e
+        except Exception as e:
+            self.stop(e)
+            return
+        if downstream is not None:
+            downstream.close()
+        else:
+            self.stop(EOFError('Pipeline drained'))
+
+    def read_frames(self):
+        index = 0
+        while True:
+            slot = self.input_queue.acquire()
+            if slot is None:
+                return
+            read_frame_into(self.input_process.stdout, slot.data)
+            slot.index = index
+            slot.timestamp = time.perf_counter_ns()
+            self.input_queue.publish(slot)
+            index += 1
+
+    def process_frames(self):
+        edges = np.empty((self.height, self.width), dtype=np.uint8)
+        while True:
+            times = {}
+            gauges = {}
+            start = time.perf_counter_ns()
+            slot = self.input_queue.get()
+            if slot is None:
+                return
+            times['waiting'] = time.perf_counter_ns() - start
+
+            if self.pacer is not None and self.pacer.is_late(slot.timestamp):
+                self.input_queue.release(slot)
+                self.pacer.dropped += 1
+                if self.on_drop is not None:
+                    self.on_drop(1)
+                continue
+
+            start = time.perf_counter_ns()
+            background_color, line_color = self.schedule.colors()
+            times['get_colors'] = time.perf_counter_ns() - start
+
+            output = self.output_queue.acquire()
+            if output is None:
+                return
+            with self.compute_slots:
+                start = time.perf_counter_ns()
+                if self.governor is not None:
+                    self.governor.detect(slot.data, out=edges)
+                elif self.tiles is not None:
+                    self.tiles.detect(slot.data, out=edges)
+                    gauges['tiles_recomputed'] = self.tiles.recomputed
+                elif self.graph is not None:
+                    self.graph.run(slot.data, out=edges)
+                    for name, value in self.graph.times.items():
+                        times[f'filter.{name}'] = value
+                elif self.strips is not None:
+                    self.strips.detect(slot.data, out=edges)
+                    if self.strips.mismatch is not None:
+                        gauges['strip_mismatch'] = self.strips.mismatch
+                else:
+                    detect_edges(slot.data, out=edges)
+                times['edges'] = time.perf_counter_ns() - start
+
+                start = time.perf_counter_ns()
+                self.renderer.render(edges, background_color, line_color, out=output.data)
+                times['colorize'] = time.perf_counter_ns() - start
+
+            if self.governor is not None:
+                self.governor.observe(times['edges'] + times['colorize'])
+
+            output.index = slot.index
+            output.timestamp = slot.timestamp
+            self.input_queue.release(slot)
+            self.output_queue.publish(output)
+
+            times['total'] = times['get_colors'] + times['edges'] + times['colorize']
+            if self.on_frame is not None:
+                self.on_frame(times, gauges)
+
+    def write_frames(self):
+        while True:
+            slot = self.output_queue.get()
+            if slot is None:
+                return
+            self.output_process.stdin.write(slot.data.data)
+            self.output_queue.release(slot)
+
+    def write_paced_frames(self):
+        pacer = self.pacer
+        last = None
+        pacer.start()
+        while True:
+            try:
+                slot = self.output_queue.get(timeout=pacer.remaining() / 1e9)
+            except queue.Empty:
+                slot = last
+                if slot is not None:
+                    # Input starved: repeat the last frame to hold the frame rate
+                    pacer.duplicated += 1
+                    if self.on_duplicate is not None:
+                        self.on_duplicate(1)
+            else:
+                if slot is None:
+                    return
+                pacer.wait()
+            if slot is not None:
+                self.output_process.stdin.write(slot.data.data)
+                if last is not None and last is not slot:
+                    self.output_queue.release(last)
+                last = slot
+            pacer.advance()
+
+    def run(self):
+        # Canny and the pipe reads/writes release the GIL, so the stages overlap
+        stages = [
+            (self.read_frames, self.input_queue),
+            (self.process_frames, self.output_queue),
+            (self.write_frames if self.pacer is None else self.write_paced_frames, None),
+        ]
+        for target, downstream in stages:
+            threading.Thread(target=self.run_stage, args=(target, downstream), daemon=True).start()
+        self.stopped.wait()
+        # The caller tears down the ffmpeg processes, which unblocks any stage
+        # still parked in a pipe read or write
+        raise self.error
@@ -1,196 +1,64 @@
-import cv2
-import numpy as np
+import argparse
+import contextlib
+import functools
+import json
+import os
+import posixpath
+import re
 import subprocess
 import time
-import datetime
-import pytz
-import matplotlib.colors as mcolors
-from astral import LocationInfo
-from astral.sun import sun
-from numba import jit
-from collections import defaultdict
-import select
-
-
-@jit(nopython=True)
-def colorize(frame, background_color, line_color, height, width):
-    colored_output = np.zeros((height, width, 3), dtype=np.uint8)
-    for i in range(height):
-        for j in range(width):
-            if frame[i, j] == 0:
-                colored_output[i, j, 0] = background_color[0]
-                colored_output[i, j, 1] = background_color[1]
-                colored_output[i, j, 2] = background_color[2]
-            else:
-                colored_output[i, j, 0] = line_color[0]
-                colored_output[i, j, 1] = line_color[1]
-                colored_output[i, j, 2] = line_color[2]
-    return colored_output
-
-def print_stats(stats):
-    print("\n{:<20} {:>25} {:>20} {:>20}".format(
-        "Operation", "Avg ± Std Dev", "% of Total", "% of Max Time"))
-    print("-" * 90)
-
-    total_avg = np.mean(stats['total'])
-    max_time = 1/30 * 1e6  # 33333.33 us
-
-    for k, v in stats.items():
-        if k == 'get_frame':
-            fv = [x for x in v if x <= 10000]
-            avg = np.mean(fv)
-            std = np.std(fv)
-        elif k == 'waiting':
-
-            avg = np.mean(v)
-            avg_seconds = avg / 1e6
-            print("{:<20} {:>10.6f}s".format(k, avg_seconds))
-            continue
-        else:
-            avg = np.mean(v)
-            std = np.std(v)
-        percent_of_total = (avg / total_avg) * 100
-        percent_of_max = (avg / max_time) * 100
-
-        # Convert avg to seconds and std to microseconds
-        avg_seconds = avg / 1e6
-        std_microseconds = std
-
-        print("{:<20} {:>10.6f}s ± {:>10.2f} us {:>18.2f}% {:>18.2f}%".format(
-            k, avg_seconds, std_microseconds, percent_of_total, percent_of_max))
-    
-    print("-" * 90)
-
-def find_midpoint(start_time, end_time):
-    return start_time + (end_time - start_time) / 2
-
-def get_color(progress, start_color, end_color, exponent=1):
-    c1 = np.array(mcolors.hex2color(start_color))
-    c2 = np.array(mcolors.hex2color(end_color))
-    color = (1 - progress**exponent) * c1 + progress**exponent * c2
-    return tuple(int(255 * x) for x in color)
-
-def get_colors():
-    london_tz = pytz.timezone('Europe/London')
-    london_datetime = datetime.datetime.now(london_tz)
-    london_old_datetime = datetime.datetime.now(london_tz) - datetime.timedelta(days=1)
-    london_next_datetime = datetime.datetime.now(london_tz) + datetime.timedelta(days=1)
-
-    london_date = london_datetime.date()
-    london_old_date = london_old_datetime.date()
-    london_next_date = london_next_datetime.date()
-
-    city = LocationInfo(latitude=51.537052, longitude=-0.183325)
-    s = sun(city.observer, date=london_date)
-    y = sun(city.observer, date=london_old_date)
-    n = sun(city.observer, date=london_next_date)
-
-    old_dusk = y['dusk'].astimezone(london_tz)
-    current_dawn = s['dawn'].astimezone(london_tz)
-    old_midnight = find_midpoint(old_dusk, current_dawn)
-
-    current_dusk = s['dusk'].astimezone(london_tz)
-    current_sunrise = s['sunrise'].astimezone(london_tz)
-    current_sunset = s['sunset'].astimezone(london_tz)
-    current_noon = find_midpoint(current_sunrise, current_sunset)
-    next_dawn = n['dawn'].astimezone(london_tz)
-    current_midnight = find_midpoint(current_dusk, next_dawn)
-
-    color_lookup = {
-        'midnight': {
-            'line': {
-                'start': '#ced4da',
-                'end': '#f8f9fa'
-            },
-            'background': {
-                'start': '#6c757d',
-                'end': '#212529',
-            },
-            'exponent': 0.25
-        },
-        'dawn': {
-            'line': {
-                'start': '#f8f9fa',
-                'end': '#ced4da'
-            },
-            'background': {
-                'start': '#212529',
-                'end': '#6c757d'
-            },
-            'exponent': 4
-        },
-        'sunrise': {
-            'line': {
-                'start': '#ced4da',
-                'end': '#6c757d'
-            },
-            'background': {
-                'start': '#6c757d',
-                'end': '#ced4da'
-            },
-            'exponent': 4
-        },
-        'afternoon': {
-            'line': {
-                'start': '#6c757d',
-                'end': '#212529'
-            },
-            'background': {
-                'start': '#ced4da',
-                'end': '#f8f9fa'
-            },
-            'exponent': .25
-        },
-        'sunset': {
-            'line': {
-                'start': '#212529',
-                'end': '#6c757d'
-            },
-            'background': {
-                'start': '#f8f9fa',
-                'end': '#ced4da'
-            },
-            'exponent': 4
-        },
-        'dusk': {
-            'line': {
-                'start': '#6c757d',
-                'end': '#ced4da'
-            },
-            'background': {
-                'start': '#ced4da',
-                'end': '#6c757d'
-            },
-            'exponent': .25
-        }
+from edges import StripEdgeDetector, TiledEdgeDetector, detect_edges
+from filters import LOOKS, build_graph
+from metrics import FrameMetrics, print_report
+from governor import QualityGovernor
+from ingest import FramePool, read_buffer_size, read_frame_into
+from parallel import ensure_process_pool
+from pipeline import DROP_POLICIES, DROP_OLDEST, BLOCK, Pipeline
+from render import PIXEL_FORMATS, ensure_renderer
+from schedule import get_schedule
+from store import STORE_PORT, STORE_SOCKET, SegmentStore, ingest_url
+from supervisor import Supervisor
+
+# Segment length, and the part length in low-latency mode, in seconds
+HLS_TIME = 3
+PART_DURATION = 0.5
+# Segments in stream.m3u8
+LIST_SIZE = 5
+# Segment extension for each -hls_segment_type. fMP4 segments share one init
+# segment per encoder run, named after the run's start so the playlist's
+# EXT-X-MAP points somewhere new whenever the encoder restarts
+SEGMENT_TYPES = {'mpegts': '.ts', 'fmp4': '.m4s'}
+INIT_SEGMENT = 'init_{}.mp4'
+HLS_ROOT = '/tmp/hls'
+# Files an encoder run writes next to its playlists
+OUTPUT_FILE = re.compile(r'^((stream|part)\d+(\.ts|\.m4s)|init_\d+\.mp4)$')
+PLAYLIST_URI = re.compile(r'URI="([^"]+)"')
+
+DEFAULT_STREAM = {
+    'name': 'abbey-road',
+    'url': 'https://videos-3.earthcam.com/fecnetwork/hdtimes10.flv/chunklist_w.m3u8',
+    'width': 640,
+    'height': 480,
+    'fps': 20,
+    'latitude': 51.537052,
+    'longitude': -0.183325,
+    'timezone': 'Europe/London',
+    'output_dir': HLS_ROOT,
+    'headers': {
+        'Accept': '*/*',
+        'Accept-Language': 'en-US,en;q=0.9',
+        'Connection': 'keep-alive',
+        'Origin': 'https://www.abbeyroad.com',
+        'Referer': 'https://www.abbeyroad.com/',
+        'Sec-Fetch-Dest': 'empty',
+        'Sec-Fetch-Mode': 'cors',
+        'Sec-Fetch-Site': 'cross-site',
+        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36',
+        'sec-ch-ua': '"Google Chrome";v="119", "Chromium";v="119", "Not?A_Brand";v="24"',
+        'sec-ch-ua-mobile': '?0',
+        'sec-ch-ua-platform': '"macOS"'
     }
-
-    if london_datetime <= old_midnight:
-        approaching = 'midnight' 
-        progress = (london_datetime - old_dusk).seconds / (old_midnight - old_dusk).seconds
-    elif london_datetime <= current_dawn:
-        approaching = 'dawn'
-        progress = (london_datetime - old_midnight).seconds / (current_dawn - old_midnight).seconds
-    elif london_datetime <= current_sunrise:
-        approaching = 'sunrise'
-        progress = (london_datetime - current_dawn).seconds / (current_sunrise - current_dawn).seconds
-    elif london_datetime <= current_noon:
-        approaching = 'afternoon'
-        progress = (london_datetime - current_sunrise).seconds / (current_noon - current_sunrise).seconds
-    elif london_datetime <= current_sunset:
-        approaching = 'sunset'
-        progress = (london_datetime - current_noon).seconds / (current_sunset - current_noon).seconds
-    elif london_datetime <= current_dusk:
-        approaching = 'dusk'
-        progress = (london_datetime - current_sunset).seconds / (current_dusk - current_sunset).seconds
-    elif london_datetime <= current_midnight:
-        approaching = 'midnight' 
-        progress = (london_datetime - current_dusk).seconds / (current_midnight - current_dusk).seconds
-    else:
-        return None
-    line_color = get_color(progress=progress, start_color=color_lookup[approaching]['line']['start'], end_color=color_lookup[approaching]['line']['end'], exponent=color_lookup[approaching]['exponent'])
-    background_color = get_color(progress=progress, start_color=color_lookup[approaching]['background']['start'], end_color=color_lookup[approaching]['background']['end'], exponent=color_lookup[approaching]['exponent'])
-    return background_color, line_color
+}
 
 def format_headers(headers):
     header_str = ""
@@ -198,24 +66,32 @@ def format_headers(headers):
         header_str += f"{key}: {value}\r\n"
     return header_str
 
-def initialize_ffmpeg_process(headers, width, height):
+def initialize_ffmpeg_process(headers, url, width, height, read_buffer_frames=1):
     # Create FFmpeg command with custom headers
     ffmpeg_command = [
         'ffmpeg',
         '-headers', headers,
-        '-i', 'https://videos-3.earthcam.com/fecnetwork/hdtimes10.flv/chunklist_w.m3u8',
+        '-i', url,
         '-f', 'rawvideo',
         '-pix_fmt', 'gray',
         '-s', f'{width}x{height}',
         '-'
     ]
-    return subprocess.Popen(ffmpeg_command, stdout=subprocess.PIPE, bufsize=10**8)
+    bufsize = read_buffer_size(width * height, read_buffer_frames)
+    return subprocess.Popen(ffmpeg_command, stdout=subprocess.PIPE, bufsize=bufsize)
+
+def output_ffmpeg_command(width, height, fps, output_dir, pix_fmt='yuv420p', low_latency=False,
+                          part_duration=PART_DURATION, segment_type='mpegts', list_size=LIST_SIZE, upload_url=None):
+    extension = SEGMENT_TYPES[segment_type]
+    # Segments and playlists are uploaded to the segment store when there is
+    # one, ffmpeg deletes expired segments there with DELETE
+    def target(name):
+        return f'{upload_url}/{name}' if upload_url else os.path.join(output_dir, name)
 
-def initialize_output_ffmpeg_process(width, height, fps):
     ffmpeg_command = [
         'ffmpeg',
         '-f', 'rawvideo',
-        '-pix_fmt', 'bgr24',
+        '-pix_fmt', pix_fmt,
         '-s', f'{width}x{height}',
         '-r', str(fps),
         '-i', '-',
@@ -224,93 +100,299 @@ def initialize_output_ffmpeg_process(width, height, fps):
         '-preset', 'fast',
         '-tune', 'zerolatency',
         '-f', 'hls',
-        '-g', str(int(fps * 3)),
-        '-hls_time', '3',
-        '-hls_list_size', '5',
-        '-hls_flags', 'delete_segments',
-        '-hls_segment_filename', './tmp/hls/stream%03d.ts',
-        '/tmp/hls/stream.m3u8'
     ]
+    if upload_url:
+        ffmpeg_command += ['-method', 'PUT', '-http_persistent', '1']
+    if segment_type == 'fmp4':
+        # CMAF: the codec headers go once into the init segment the playlist
+        # points to with EXT-X-MAP, segments only carry moof/mdat fragments
+        ffmpeg_command += [
+            '-hls_segment_type', 'fmp4',
+            '-hls_fmp4_init_filename', INIT_SEGMENT.format(int(time.time())),
+        ]
+    if low_latency:
+        # Parts instead of segments: a keyframe at the start of every part so
+        # each one can be played on its own, numbered from the clock so the
+        # numbers keep increasing when the encoder restarts. The origin builds
+        # the LL-HLS playlist and whole segments from parts.m3u8
+        ffmpeg_command += [
+            '-g', str(max(round(fps * part_duration), 1)),
+            '-hls_time', str(part_duration),
+            '-hls_list_size', str(round(HLS_TIME / part_duration) * list_size),
+            '-hls_flags', 'delete_segments+temp_file+independent_segments',
+            '-hls_start_number_source', 'epoch_us',
+            '-hls_segment_filename', target(f'part%d{extension}'),
+            target('parts.m3u8')
+        ]
+    else:
+        # Numbered from the clock, so a reconnect never writes a new segment
+        # under a URL the origin already served as immutable
+        ffmpeg_command += [
+            '-g', str(int(fps * HLS_TIME)),
+            '-hls_time', str(HLS_TIME),
+            '-hls_list_size', str(list_size),
+            '-hls_flags', 'delete_segments',
+            '-hls_start_number_source', 'epoch',
+            '-hls_segment_filename', target(f'stream%03d{extension}'),
+            target('stream.m3u8')
+        ]
+    return ffmpeg_command
+
+def listed_files(output_dir):
+    # Every file a playlist in output_dir points to, segments, parts and maps
+    names = set()
+    for name in os.listdir(output_dir):
+        if not name.endswith('.m3u8'):
+            continue
+        try:
+            with open(os.path.join(output_dir, name)) as f:
+                playlist = f.read()
+        except FileNotFoundError:
+            continue
+        for line in playlist.splitlines():
+            if line and not line.startswith('#'):
+                names.add(posixpath.basename(line))
+            names.update(posixpath.basename(uri) for uri in PLAYLIST_URI.findall(line))
+    return names
+
+def remove_stale_files(output_dir, max_age=LIST_SIZE * HLS_TIME):
+    # ffmpeg only deletes the segments of its own run, and segment numbers
+    # are never reused, so whatever an earlier run left behind would stay
+    # forever. Anything no playlist lists and that is older than a playlist
+    # window no player can still ask for
+    listed = listed_files(output_dir)
+    oldest = time.time() - max_age
+    for name in os.listdir(output_dir):
+        if not OUTPUT_FILE.match(name) or name in listed:
+            continue
+        path = os.path.join(output_dir, name)
+        with contextlib.suppress(FileNotFoundError):
+            if os.stat(path).st_mtime < oldest:
+                os.remove(path)
+
+def initialize_output_ffmpeg_process(width, height, fps, output_dir, pix_fmt='yuv420p', low_latency=False,
+                                     part_duration=PART_DURATION, segment_type='mpegts', upload_url=None):
+    os.makedirs(output_dir, exist_ok=True)
+    remove_stale_files(output_dir)
+    ffmpeg_command = output_ffmpeg_command(width, height, fps, output_dir, pix_fmt, low_latency, part_duration,
+                                           segment_type, upload_url=upload_url)
     return subprocess.Popen(ffmpeg_command, stdin=subprocess.PIPE)
 
-def process_frame(input_process, output_process, width, height, frame_count, stats):
-    times = {'waiting': 0}
-
-    start = time.time()
-    frame = input_process.stdout.read(width * height)
-    read_time = time.time() - start
-    times['get_frame'] = min(read_time, .005)
-    if times['get_frame'] == .005:
-        times['waiting'] = read_time - .005
-
-    start = time.time()
-    background_color, line_color = get_colors()
-    times['get_colors'] = time.time() - start
-
-    start = time.time()
-    array = np.frombuffer(frame, dtype=np.uint8).reshape((height, width))
-    times['convert_array'] = time.time() - start
-
-    start = time.time()
-    edges = cv2.Canny(array, 575, 600, apertureSize=5, L2gradient=True)
-    times['edges'] = time.time() - start
-
-    start = time.time()
-    colored_output = colorize(edges, background_color, line_color, height, width)
-    times['colorize'] = time.time() - start
-
-    start = time.time()
-    output_process.stdin.write(colored_output.tobytes())
-    times['send_output'] = time.time() - start
-
-    times['total'] = times['get_frame'] + times['get_colors'] + times['convert_array'] + times['edges'] + times['colorize'] + times['send_output']
-    
-    # Update stats
-    for k, v in times.items():
-        stats[k].append(v * 1e6)  # Convert to microseconds
-
-    # Print stats every 90 frames
-    if frame_count % 90 == 0:
-        print_stats(stats)
-        stats.clear()
-    
-    return True
-        
-def main():
-    # Specify global variables
-    width = 640
-    height = 480
-    fps = 20
-    headers = {
-        'Accept': '*/*',
-        'Accept-Language': 'en-US,en;q=0.9',
-        'Connection': 'keep-alive',
-        'Origin': 'https://www.abbeyroad.com',
-        'Referer': 'https://www.abbeyroad.com/',
-        'Sec-Fetch-Dest': 'empty',
-        'Sec-Fetch-Mode': 'cors',
-        'Sec-Fetch-Site': 'cross-site',
-        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36',
-        'sec-ch-ua': '"Google Chrome";v="119", "Chromium";v="119", "Not?A_Brand";v="24"',
-        'sec-ch-ua-mobile': '?0',
-        'sec-ch-ua-platform': '"macOS"'
-    }
-    formatted_headers = format_headers(headers)
-    frame_count = 0
-    stats = defaultdict(list)
+def process_frame(input_process, output_process, frame_pool, renderer, schedule, compute_slots=None, governor=None,
+                  tiles=None, strips=None, graph=None):
+    times = {}
+    gauges = {}
+
+    start = time.perf_counter_ns()
+    array = frame_pool.take()
+    read_frame_into(input_process.stdout, array)
+    times['get_frame'] = time.perf_counter_ns() - start
+
+    start = time.perf_counter_ns()
+    background_color, line_color = schedule.colors()
+    times['get_colors'] = time.perf_counter_ns() - start
+
+    with compute_slots or contextlib.nullcontext():
+        start = time.perf_counter_ns()
+        regions = None
+        if governor is not None:
+            edges = governor.detect(array)
+        elif tiles is not None:
+            edges = tiles.detect(array)
+            regions = tiles.regions
+            gauges['tiles_recomputed'] = tiles.recomputed
+        elif graph is not None:
+            edges = graph.run(array)
+            for name, value in graph.times.items():
+                times[f'filter.{name}'] = value
+        elif strips is not None:
+            edges = strips.detect(array)
+            if strips.mismatch is not None:
+                gauges['strip_mismatch'] = strips.mismatch
+        else:
+            edges = detect_edges(array)
+        times['edges'] = time.perf_counter_ns() - start
+
+        start = time.perf_counter_ns()
+        # Unchanged tiles keep last frame's pixels in the renderer's buffer
+        colored_output = renderer.render(edges, background_color, line_color, regions=regions)
+        times['colorize'] = time.perf_counter_ns() - start
+
+    start = time.perf_counter_ns()
+    output_process.stdin.write(colored_output.data)
+    times['send_output'] = time.perf_counter_ns() - start
+
+    if governor is not None:
+        governor.observe(times['edges'] + times['colorize'])
+
+    times['total'] = times['get_frame'] + times['get_colors'] + times['edges'] + times['colorize'] + times['send_output']
+    return times, gauges
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', choices=['serial', 'threaded', 'process'], default='serial',
+                        help='threaded overlaps reading, processing and encoding on separate threads, '
+                             'process spreads edge detection and rendering over worker processes')
+    parser.add_argument('--queue-size', type=int, default=4,
+                        help='frames buffered between threaded stages')
+    parser.add_argument('--input-policy', choices=DROP_POLICIES, default=DROP_OLDEST,
+                        help='what the reader does when processing falls behind')
+    parser.add_argument('--output-policy', choices=DROP_POLICIES, default=BLOCK,
+                        help='what processing does when the encoder falls behind')
+    parser.add_argument('--pix-fmt', choices=PIXEL_FORMATS, default='yuv420p',
+                        help='raw format handed to the encoder, yuv420p/nv12 send half the bytes of bgr24 '
+                             'and skip the conversion inside ffmpeg')
+    parser.add_argument('--pace', action='store_true',
+                        help='threaded mode only: write to the encoder at exactly the stream fps, dropping late '
+                             'frames and repeating the last one when the input stalls')
+    parser.add_argument('--governor', action='store_true',
+                        help='serial and threaded modes: step edge detection resolution and aperture down a '
+                             'ladder when frames run over budget, and back up when there is headroom')
+    parser.add_argument('--incremental', action='store_true',
+                        help='serial and threaded modes: split frames into tiles and only rerun edge detection '
+                             'on tiles whose input changed since they were last computed')
+    parser.add_argument('--tile-size', type=int, default=64,
+                        help='edge length in pixels of the --incremental tiles, must be even')
+    parser.add_argument('--tile-threshold', type=int, default=16,
+                        help='gray levels a pixel must move by to count as changed with --incremental')
+    parser.add_argument('--tile-sensitivity', type=float, default=0.01,
+                        help='fraction of changed pixels that marks a whole tile as changed with --incremental')
+    parser.add_argument('--filters', default=None,
+                        help=f'filter graph that turns frames into the line mask, one of {", ".join(LOOKS)} or a '
+                             'JSON file listing stages, a registry entry can set its own')
+    parser.add_argument('--strips', type=int, default=1,
+                        help='serial and threaded modes: run Canny on this many overlapping horizontal strips '
+                             'on a thread pool, 0 picks by frame height, a registry entry can set its own')
+    parser.add_argument('--verify-strips', type=int, default=0,
+                        help='every this many frames compare the stitched strips with a full frame Canny and '
+                             'report the share of pixels that differ')
+    parser.add_argument('--low-latency', action='store_true',
+                        help='write LL-HLS parts of --part-duration seconds for server.py --low-latency')
+    parser.add_argument('--part-duration', type=float, default=PART_DURATION,
+                        help='seconds per part in low-latency mode, must match the server\'s --part-target')
+    parser.add_argument('--segment-type', choices=SEGMENT_TYPES, default='mpegts',
+                        help='fmp4 writes CMAF segments with an init segment instead of MPEG-TS')
+    parser.add_argument('--store-socket', nargs='?', const=STORE_SOCKET, default=None,
+                        help=f'keep playlists and segments in memory and publish them to server.py on this Unix '
+                             f'socket (default {STORE_SOCKET}). They are still written to {HLS_ROOT} as a fallback')
+    parser.add_argument('--store-port', type=int, default=STORE_PORT,
+                        help='localhost port ffmpeg uploads to when --store-socket is set')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='worker processes in process mode, and streams processing frames at once with a registry')
+    parser.add_argument('--max-in-flight', type=int, default=None,
+                        help='frames being processed at once in process mode, defaults to twice the workers')
+    parser.add_argument('--registry', default=None,
+                        help='JSON list of streams to run side by side instead of the default stream')
+    parser.add_argument('--status-interval', type=float, default=10,
+                        help='seconds between per-stream status reports when running a registry')
+    parser.add_argument('--status-file', default=None,
+                        help='also write the per-stream status report to this JSON file')
+    parser.add_argument('--stats-interval', type=float, default=5,
+                        help='seconds between latency reports for the default stream')
+    parser.add_argument('--read-buffer', type=int, default=1,
+                        help='frames of Python-side buffering on the input pipe, 0 for unbuffered')
+    args = parser.parse_args()
+    if args.pace and args.mode != 'threaded':
+        parser.error('--pace needs --mode threaded')
+    if args.governor and args.mode == 'process':
+        parser.error('--governor works with the serial and threaded modes')
+    if args.incremental and args.mode == 'process':
+        parser.error('--incremental works with the serial and threaded modes')
+    if args.incremental and args.governor:
+        parser.error('--incremental and --governor both replace edge detection, pick one')
+    if args.strips != 1 and (args.mode == 'process' or args.incremental or args.governor):
+        parser.error('--strips works with the serial and threaded modes, without --incremental or --governor')
+    if args.filters and (args.incremental or args.governor or args.strips != 1):
+        parser.error('--filters replaces edge detection, it cannot be combined with --incremental, --governor or --strips')
+    if args.tile_size < 8 or args.tile_size % 2:
+        parser.error('--tile-size must be an even number of at least 8')
+    return args
+
+def load_registry(path):
+    with open(path) as f:
+        entries = json.load(f)
+    streams = []
+    for entry in entries:
+        # Resolution, fps and location fall back to the default stream's
+        stream = {key: value for key, value in DEFAULT_STREAM.items() if key not in ('name', 'url', 'headers', 'output_dir')}
+        stream.update(entry)
+        stream.setdefault('headers', {})
+        stream.setdefault('output_dir', os.path.join(HLS_ROOT, stream['name']))
+        streams.append(stream)
+    return streams
+
+def run_stream(args, stream, on_frame, on_error=None, on_drop=None, on_duplicate=None, compute_slots=None, stop_event=None,
+               workers=None):
+    width = stream['width']
+    height = stream['height']
+    fps = stream['fps']
+    formatted_headers = format_headers(stream['headers'])
+    renderer = None
+    frame_pool = None
+    process_pool = None
+    # Worker processes of this stream's pool in process mode, a share of
+    # --workers when a registry runs several streams
+    workers = workers or args.workers
+    max_in_flight = args.max_in_flight or workers * 2
+    schedule = get_schedule(stream['latitude'], stream['longitude'], stream['timezone'])
+    governor = None
+    if args.governor:
+        governor = QualityGovernor(width, height, fps, ladder=stream.get('ladder'), name=stream['name'])
+    tiles = None
+    if args.incremental:
+        tiles = TiledEdgeDetector(width, height, tile_size=args.tile_size, pixel_threshold=args.tile_threshold,
+                                  sensitivity=args.tile_sensitivity)
+    graph = None
+    filters = stream.get('filters', args.filters)
+    if filters and not (args.incremental or args.governor):
+        # Built once per stream, its buffers are reused for every frame
+        graph = build_graph(filters, width, height)
+    strips = None
+    strip_count = stream.get('strips', args.strips)
+    if strip_count != 1 and graph is None and not (args.incremental or args.governor or args.mode == 'process'):
+        strips = StripEdgeDetector(width, height, strips=strip_count, verify_interval=args.verify_strips)
+
+    upload_url = None
+    if args.store_socket:
+        upload_url = ingest_url(args.store_port, HLS_ROOT, stream['output_dir'])
 
     # Start running indefinite loop
-    while True:
+    while stop_event is None or not stop_event.is_set():
         try:
-            input_process = initialize_ffmpeg_process(formatted_headers, width, height)
-            output_process = initialize_output_ffmpeg_process(width, height, fps)
-            while True:
-                process_frame(input_process, output_process, width, height, frame_count, stats)
-                frame_count += 1
-                
+            input_process = initialize_ffmpeg_process(formatted_headers, stream['url'], width, height, args.read_buffer)
+            output_process = initialize_output_ffmpeg_process(width, height, fps, stream['output_dir'], args.pix_fmt,
+                                                              args.low_latency, args.part_duration, args.segment_type,
+                                                              upload_url)
+            # Only rebuilt when the resolution changes, not on every reconnect
+            renderer = ensure_renderer(renderer, width, height, args.pix_fmt)
+            if frame_pool is None or frame_pool.shape != (height, width):
+                frame_pool = FramePool(2, width, height)
+            if tiles is not None:
+                # The first frame after a reconnect has nothing to compare with
+                tiles.reset()
+            if args.mode == 'threaded':
+                pipeline = Pipeline(input_process, output_process, renderer, schedule, width, height,
+                                    queue_size=args.queue_size, input_policy=args.input_policy,
+                                    output_policy=args.output_policy, on_frame=on_frame,
+                                    on_drop=on_drop, on_duplicate=on_duplicate, compute_slots=compute_slots,
+                                    fps=fps if args.pace else None, governor=governor, tiles=tiles,
+                                    strips=strips, graph=graph)
+                pipeline.run()
+            elif args.mode == 'process':
+                process_pool = ensure_process_pool(process_pool, width, height, workers, max_in_flight, args.pix_fmt,
+                                                   filters)
+                process_pool.run(input_process, output_process, schedule, on_frame=on_frame,
+                                 compute_slots=compute_slots)
+            else:
+                while stop_event is None or not stop_event.is_set():
+                    on_frame(*process_frame(input_process, output_process, frame_pool, renderer, schedule,
+                                            compute_slots, governor, tiles, strips, graph))
+
         except Exception as e:
-            print(f'Pipe broken: {e}')
-            print(f'Attempting to recreate processes...')
+            print(f'[{stream["name"]}] Pipe broken: {e}')
+            print(f'[{stream["name"]}] Attempting to recreate processes...')
+            if on_error is not None:
+                on_error(e)
 
             # Close existing processes if they're still running
             if 'input_process' in locals():
@@ -321,5 +403,35 @@ def main():
             # Wait a bit before retrying
             time.sleep(3)
 
+    if process_pool is not None:
+        process_pool.close()
+    if strips is not None:
+        strips.close()
+
+def main():
+    args = parse_args()
+    if args.store_socket:
+        # One store for every stream of the process
+        SegmentStore(HLS_ROOT, args.store_port, args.store_socket).start()
+
+    if args.registry:
+        streams = load_registry(args.registry)
+        # In process mode every stream forks its own pool, so the --workers
+        # processes are split between them instead of each getting all of them
+        workers = max(args.workers // len(streams), 1)
+        supervisor = Supervisor(streams, functools.partial(run_stream, args, workers=workers), args.workers,
+                                args.status_interval, args.status_file)
+        supervisor.run()
+        return
+
+    metrics = FrameMetrics(DEFAULT_STREAM['fps'], window=args.stats_interval)
+
+    def on_frame(times, gauges=None):
+        metrics.record(times, gauges)
+        if metrics.due():
+            print_report(metrics.report())
+
+    run_stream(args, DEFAULT_STREAM, on_frame, on_drop=metrics.drop, on_duplicate=metrics.duplicate)
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,162 @@
+import cv2
+import numpy as np
+
+PIXEL_FORMATS = ('yuv420p', 'nv12', 'bgr24')
+
+
+def frame_shape(width, height, pix_fmt):
+    if pix_fmt == 'bgr24':
+        return (height, width, 3)
+    # Full resolution luma followed by two quarter resolution chroma planes
+    return (height * width * 3 // 2,)
+
+def bgr_to_yuv(color):
+    # BT.601 limited range, what ffmpeg assumed when it converted our bgr24
+    b, g, r = (float(c) for c in color)
+    y = 16 + (65.481 * r + 128.553 * g + 24.966 * b) / 255
+    u = 128 + (-37.797 * r - 74.203 * g + 112.0 * b) / 255
+    v = 128 + (112.0 * r - 93.786 * g - 18.214 * b) / 255
+    return tuple(int(np.clip(round(c), 0, 255)) for c in (y, u, v))
+
+
+class Renderer:
+    def __init__(self, width, height, pix_fmt='bgr24'):
+        if pix_fmt not in PIXEL_FORMATS:
+            raise ValueError(f'Unknown pixel format: {pix_fmt}')
+        if pix_fmt != 'bgr24' and (width % 2 or height % 2):
+            raise ValueError(f'{pix_fmt} needs an even frame size, got {width}x{height}')
+        self.width = width
+        self.height = height
+        self.shape = (height, width)
+        self.pix_fmt = pix_fmt
+        # Reused for every frame so rendering never allocates
+        self.output = np.empty(frame_shape(width, height, pix_fmt), dtype=np.uint8)
+        if pix_fmt == 'bgr24':
+            # One BGR row of the palette, flattened so numpy broadcasts over
+            # contiguous rows instead of the short color axis
+            self.background_row = np.empty((1, width * 3), dtype=np.uint8)
+            self.delta_row = np.empty((1, width * 3), dtype=np.uint8)
+        else:
+            chroma_shape = (height // 2, width // 2)
+            # Edge pixels per 2x2 block, as the block average of the mask
+            self.coverage = np.empty(chroma_shape, dtype=np.uint8)
+            self.chroma = [np.empty(chroma_shape, dtype=np.uint8) for _ in range(2)]
+            self.chroma_luts = [np.empty(256, dtype=np.uint8) for _ in range(2)]
+            self.flat_chroma = None
+            # Chroma LUT index for 0-4 edge pixels in a 2x2 block, matching
+            # what INTER_AREA averages the block to
+            self.block_coverage = np.array([0, 64, 128, 191, 255], dtype=np.uint8)
+        self.colors = None
+        # Palette self.output was last drawn with, partial renders are only
+        # valid on top of a frame drawn with the same colors
+        self.output_colors = None
+
+    def set_colors(self, background_color, line_color):
+        colors = (tuple(background_color), tuple(line_color))
+        if colors == self.colors:
+            return
+        self.colors = colors
+        if self.pix_fmt == 'bgr24':
+            background = np.array(background_color, dtype=np.uint8)
+            line = np.array(line_color, dtype=np.uint8)
+            self.background_row[0] = np.tile(background, self.width)
+            # uint8 wraparound makes background + delta land exactly on the line color
+            self.delta_row[0] = np.tile(line - background, self.width)
+            return
+
+        # Converted once per color change instead of by the encoder per pixel
+        background = bgr_to_yuv(background_color)
+        line = bgr_to_yuv(line_color)
+        self.background_luma = background[0]
+        self.delta_luma = (line[0] - background[0]) % 256
+        coverage = np.arange(256) / 255
+        for plane in range(2):
+            start, end = background[plane + 1], line[plane + 1]
+            self.chroma_luts[plane][:] = np.round(start + (end - start) * coverage)
+        # Most palettes are gray, then chroma is the same everywhere
+        if background[1:] == line[1:]:
+            self.flat_chroma = background[1:]
+        else:
+            self.flat_chroma = None
+
+    def planes(self, out):
+        luma_size = self.width * self.height
+        chroma_shape = (self.height // 2, self.width // 2)
+        y = out[:luma_size].reshape(self.shape)
+        if self.pix_fmt == 'yuv420p':
+            chroma_size = luma_size // 4
+            u = out[luma_size:luma_size + chroma_size].reshape(chroma_shape)
+            v = out[luma_size + chroma_size:].reshape(chroma_shape)
+        else:
+            # NV12 interleaves U and V in a single half height plane
+            uv = out[luma_size:].reshape(chroma_shape + (2,))
+            u, v = uv[..., 0], uv[..., 1]
+        return y, u, v
+
+    def render(self, edges, background_color, line_color, out=None, regions=None):
+        # edges is a Canny mask, so every pixel is either 0 or 255
+        self.set_colors(background_color, line_color)
+        if out is None:
+            out = self.output
+            # With regions, only those (top, bottom, left, right) rectangles
+            # changed since the last frame drawn into self.output
+            if regions is not None and self.output_colors == self.colors:
+                for region in regions:
+                    self.render_region(edges, out, *region)
+                return out
+            self.output_colors = self.colors
+        if self.pix_fmt == 'bgr24':
+            cv2.cvtColor(edges, cv2.COLOR_GRAY2BGR, dst=out)
+            rows = out.reshape(self.height, self.width * 3)
+            np.bitwise_and(rows, self.delta_row, out=rows)
+            np.add(rows, self.background_row, out=rows)
+            return out
+
+        y, u, v = self.planes(out)
+        np.bitwise_and(edges, self.delta_luma, out=y)
+        np.add(y, self.background_luma, out=y)
+        if self.flat_chroma is not None:
+            u[:] = self.flat_chroma[0]
+            v[:] = self.flat_chroma[1]
+            return out
+        # Mixed blocks get chroma in proportion to how much of them is line,
+        # like averaging the four full resolution pixels would
+        cv2.resize(edges, (self.width // 2, self.height // 2), dst=self.coverage, interpolation=cv2.INTER_AREA)
+        for plane, target in zip(range(2), (u, v)):
+            if target.flags.c_contiguous:
+                cv2.LUT(self.coverage, self.chroma_luts[plane], dst=target)
+            else:
+                cv2.LUT(self.coverage, self.chroma_luts[plane], dst=self.chroma[plane])
+                target[:] = self.chroma[plane]
+        return out
+
+    def render_region(self, edges, out, top, bottom, left, right):
+        mask = edges[top:bottom, left:right]
+        if self.pix_fmt == 'bgr24':
+            pixels = out[top:bottom, left:right]
+            width = right - left
+            np.bitwise_and(mask[..., np.newaxis], self.delta_row[0, :width * 3].reshape(width, 3), out=pixels)
+            np.add(pixels, self.background_row[0, :width * 3].reshape(width, 3), out=pixels)
+            return
+
+        y, u, v = self.planes(out)
+        np.bitwise_and(mask, self.delta_luma, out=y[top:bottom, left:right])
+        np.add(y[top:bottom, left:right], self.background_luma, out=y[top:bottom, left:right])
+        blocks = (slice(top // 2, bottom // 2), slice(left // 2, right // 2))
+        if self.flat_chroma is not None:
+            u[blocks] = self.flat_chroma[0]
+            v[blocks] = self.flat_chroma[1]
+            return
+        # Region edges are even, so every 2x2 block lies inside the region
+        count = mask[0::2, 0::2] & 1
+        count += mask[1::2, 0::2] & 1
+        count += mask[0::2, 1::2] & 1
+        count += mask[1::2, 1::2] & 1
+        coverage = self.block_coverage[count]
+        for plane, target in zip(range(2), (u, v)):
+            target[blocks] = self.chroma_luts[plane][coverage]
+
+def ensure_renderer(renderer, width, height, pix_fmt='bgr24'):
+    if renderer is None or renderer.shape != (height, width) or renderer.pix_fmt != pix_fmt:
+        return Renderer(width, height, pix_fmt)
+    return renderer
@@ -0,0 +1,175 @@
+import datetime
+import functools
+import time
+
+import matplotlib.colors as mcolors
+import numpy as np
+import pytz
+from astral import LocationInfo
+from astral.sun import sun
+
+color_lookup = {
+    'midnight': {
+        'line': {
+            'start': '#ced4da',
+            'end': '#f8f9fa'
+        },
+        'background': {
+            'start': '#6c757d',
+            'end': '#212529',
+        },
+        'exponent': 0.25
+    },
+    'dawn': {
+        'line': {
+            'start': '#f8f9fa',
+            'end': '#ced4da'
+        },
+        'background': {
+            'start': '#212529',
+            'end': '#6c757d'
+        },
+        'exponent': 4
+    },
+    'sunrise': {
+        'line': {
+            'start': '#ced4da',
+            'end': '#6c757d'
+        },
+        'background': {
+            'start': '#6c757d',
+            'end': '#ced4da'
+        },
+        'exponent': 4
+    },
+    'afternoon': {
+        'line': {
+            'start': '#6c757d',
+            'end': '#212529'
+        },
+        'background': {
+            'start': '#ced4da',
+            'end': '#f8f9fa'
+        },
+        'exponent': .25
+    },
+    'sunset': {
+        'line': {
+            'start': '#212529',
+            'end': '#6c757d'
+        },
+        'background': {
+            'start': '#f8f9fa',
+            'end': '#ced4da'
+        },
+        'exponent': 4
+    },
+    'dusk': {
+        'line': {
+            'start': '#6c757d',
+            'end': '#ced4da'
+        },
+        'background': {
+            'start': '#ced4da',
+            'end': '#6c757d'
+        },
+        'exponent': .25
+    }
+}
+
+
+def find_midpoint(start_time, end_time):
+    return start_time + (end_time - start_time) / 2
+
+def get_color_table(progress, start_color, end_color, exponent=1):
+    c1 = np.array(mcolors.hex2color(start_color))
+    c2 = np.array(mcolors.hex2color(end_color))
+    weight = (progress ** exponent)[:, np.newaxis]
+    color = (1 - weight) * c1 + weight * c2
+    # Truncate like int() did for the per-frame colors
+    return (255 * color).astype(np.uint8)
+
+
+class ColorSchedule:
+    def __init__(self, latitude, longitude, timezone, resolution=1.0):
+        self.timezone = pytz.timezone(timezone)
+        self.observer = LocationInfo(latitude=latitude, longitude=longitude).observer
+        # Seconds covered by each row of the table
+        self.resolution = resolution
+        # (day start, day end, table), replaced as a whole so streams sharing
+        # the schedule never pair one day's bounds with another day's table.
+        # Row i of the table holds the (background, line) colors for that
+        # slice of the day
+        self.day = (0.0, 0.0, None)
+
+    def colors(self, now=None):
+        if now is None:
+            now = time.time()
+        day_start, day_end, table = self.day
+        if not day_start <= now < day_end:
+            day_start, day_end, table = self.build(now)
+        row = table[int((now - day_start) // self.resolution)]
+        return row[0], row[1]
+
+    def boundaries(self, date):
+        tz = self.timezone
+        s = sun(self.observer, date=date)
+        y = sun(self.observer, date=date - datetime.timedelta(days=1))
+        n = sun(self.observer, date=date + datetime.timedelta(days=1))
+
+        old_dusk = y['dusk'].astimezone(tz)
+        current_dawn = s['dawn'].astimezone(tz)
+        old_midnight = find_midpoint(old_dusk, current_dawn)
+
+        current_dusk = s['dusk'].astimezone(tz)
+        current_sunrise = s['sunrise'].astimezone(tz)
+        current_sunset = s['sunset'].astimezone(tz)
+        current_noon = find_midpoint(current_sunrise, current_sunset)
+        next_dawn = n['dawn'].astimezone(tz)
+        current_midnight = find_midpoint(current_dusk, next_dawn)
+
+        # (phase being approached, phase start, phase end)
+        return [
+            ('midnight', old_dusk, old_midnight),
+            ('dawn', old_midnight, current_dawn),
+            ('sunrise', current_dawn, current_sunrise),
+            ('afternoon', current_sunrise, current_noon),
+            ('sunset', current_noon, current_sunset),
+            ('dusk', current_sunset, current_dusk),
+            ('midnight', current_dusk, current_midnight),
+            # get_colors gave up after midnight, keep heading for tomorrow's dawn
+            ('dawn', current_midnight, next_dawn),
+        ]
+
+    def build(self, now):
+        tz = self.timezone
+        date = datetime.datetime.fromtimestamp(now, tz).date()
+        start = tz.localize(datetime.datetime.combine(date, datetime.time.min))
+        end = tz.localize(datetime.datetime.combine(date + datetime.timedelta(days=1), datetime.time.min))
+        day_start = start.timestamp()
+        day_end = end.timestamp()
+
+        rows = int(np.ceil((day_end - day_start) / self.resolution))
+        times = day_start + np.arange(rows) * self.resolution
+        table = np.empty((rows, 2, 3), dtype=np.uint8)
+        remaining = np.ones(rows, dtype=bool)
+        for approaching, phase_start, phase_end in self.boundaries(date):
+            phase_start = phase_start.timestamp()
+            phase_end = phase_end.timestamp()
+            mask = remaining & (times <= phase_end)
+            if not mask.any():
+                continue
+            remaining &= ~mask
+            # Whole seconds, matching the timedelta.seconds arithmetic
+            progress = np.floor(times[mask] - phase_start) / np.floor(phase_end - phase_start)
+            phase = color_lookup[approaching]
+            table[mask, 0] = get_color_table(progress, phase['background']['start'], phase['background']['end'], phase['exponent'])
+            table[mask, 1] = get_color_table(progress, phase['line']['start'], phase['line']['end'], phase['exponent'])
+        day = self.day = (day_start, day_end, table)
+        return day
+
+
+@functools.lru_cache(maxsize=None)
+def get_schedule(latitude, longitude, timezone, resolution=1.0):
+    # Cameras at the same spot share one table
+    return ColorSchedule(latitude, longitude, timezone, resolution)
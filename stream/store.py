@@ -0,0 +1,252 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import json
+import os
+import posixpath
+import threading
+import time
+import urllib.parse
+
+# ffmpeg uploads its playlists and segments to this port on localhost, the
+# origin follows the store on the Unix socket
+STORE_PORT = 8900
+STORE_SOCKET = '/run/morph/segments.sock'
+MAX_HEADER_BYTES = 16 * 1024
+# Segments left behind by an encoder restart are never deleted by ffmpeg, the
+# oldest ones leave memory once the store holds more than this. The stream
+# clears them from disk when it restarts
+DEFAULT_STORE_BYTES = 256 * 1024 * 1024
+# A subscriber this far behind is dropped, it resyncs from a snapshot when it
+# reconnects
+MAX_SUBSCRIBER_BUFFER = 64 * 1024 * 1024
+# Never evicted: playlists are rewritten in place, and the fMP4 init segment
+# is the oldest file of every encoder run. An init segment leaves memory when
+# the next run publishes its own
+KEPT_EXTENSIONS = ('.m3u8', '.mp4')
+INIT_EXTENSION = '.mp4'
+REASONS = {
+    200: 'OK',
+    201: 'Created',
+    204: 'No Content',
+    400: 'Bad Request',
+    405: 'Method Not Allowed',
+}
+
+
+def ingest_url(port, root, output_dir):
+    # Where ffmpeg uploads a stream writing to output_dir
+    relative = os.path.relpath(output_dir, root)
+    if relative == os.curdir:
+        return f'http://127.0.0.1:{port}'
+    if relative.startswith(os.pardir):
+        raise ValueError(f'{output_dir} is outside of the store root {root}')
+    return f'http://127.0.0.1:{port}/{urllib.parse.quote(relative)}'
+
+def parse_request(data):
+    lines = data.decode('latin-1').split('\r\n')
+    method, target, version = lines[0].split(' ')
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return method, target, version, headers
+
+def relative_path(target):
+    # Store paths are relative to the HLS root, and never reach outside of it
+    path = posixpath.normpath(urllib.parse.unquote(urllib.parse.urlsplit(target).path)).lstrip('/')
+    if not path or path == '.' or path.startswith('..'):
+        return None
+    return path
+
+async def read_body(reader, headers):
+    # ffmpeg's HTTP output sends chunked bodies unless told otherwise
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                while (await reader.readline()).strip():
+                    pass
+                return b''.join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+    return await reader.readexactly(int(headers.get('content-length', '0')))
+
+def write_file(path, body):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_file = f'{path}.store.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(body)
+    os.replace(tmp_file, path)
+
+def remove_file(path):
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+
+def update_frame(op, path, generation, mtime_ns=0, body=b''):
+    # One JSON header line, then size bytes of body
+    header = {'op': op, 'path': path, 'generation': generation, 'mtime_ns': mtime_ns, 'size': len(body)}
+    return json.dumps(header).encode() + b'\n' + body
+
+
+class StoreEntry:
+    def __init__(self, generation, mtime_ns, body):
+        self.generation = generation
+        self.mtime_ns = mtime_ns
+        self.body = body
+
+
+class SegmentStore:
+    def __init__(self, root, port=STORE_PORT, socket_path=STORE_SOCKET, max_bytes=DEFAULT_STORE_BYTES, mirror=True):
+        self.root = root
+        self.port = port
+        self.socket_path = socket_path
+        self.max_bytes = max_bytes
+        # Relative path -> StoreEntry, in publish order
+        self.entries = {}
+        self.size = 0
+        # Bumped on every publish and delete. A file is only published once
+        # its whole body has arrived, so a reader holding generation N sees
+        # every file as of the Nth change and never half of an upload
+        self.generation = 0
+        self.subscribers = set()
+        # Files are mirrored to disk on one thread, in publish order, so a
+        # reader falling back to disk never sees a playlist before its
+        # segments. The upload is acknowledged before the disk write
+        self.disk = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='store-disk') if mirror else None
+        self.loop = None
+        self.error = None
+
+    def start(self):
+        # Serves on its own event loop thread, returns once both sockets listen
+        ready = threading.Event()
+        threading.Thread(target=self.run, args=(ready,), daemon=True, name='segment-store').start()
+        ready.wait()
+        if self.error is not None:
+            raise self.error
+
+    def run(self, ready):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.listen())
+        except OSError as e:
+            self.error = e
+            return
+        finally:
+            ready.set()
+        self.loop.run_forever()
+
+    async def listen(self):
+        await asyncio.start_server(self.handle_upload, '127.0.0.1', self.port, limit=MAX_HEADER_BYTES)
+        os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.socket_path)
+        await asyncio.start_unix_server(self.handle_subscriber, self.socket_path)
+
+    def publish(self, path, body):
+        self.generation += 1
+        previous = self.entries.pop(path, None)
+        if previous is not None:
+            self.size -= len(previous.body)
+        entry = self.entries[path] = StoreEntry(self.generation, time.time_ns(), body)
+        self.size += len(body)
+        self.broadcast(update_frame('put', path, entry.generation, entry.mtime_ns, body))
+        if self.disk is not None:
+            self.disk.submit(write_file, os.path.join(self.root, path), body)
+        if path.endswith(INIT_EXTENSION):
+            self.drop_previous_inits(path)
+        self.evict()
+
+    def drop(self, path):
+        # Out of memory only, the file stays on disk
+        entry = self.entries.pop(path, None)
+        if entry is None:
+            return
+        self.size -= len(entry.body)
+        self.generation += 1
+        self.broadcast(update_frame('delete', path, self.generation))
+
+    def remove(self, path):
+        # ffmpeg deleted it, from disk too
+        self.drop(path)
+        if self.disk is not None:
+            self.disk.submit(remove_file, os.path.join(self.root, path))
+
+    def drop_previous_inits(self, path):
+        # Segments still listed from the previous run are evicted or deleted
+        # before long, its init segment is served from disk until then
+        directory = posixpath.dirname(path)
+        for other in list(self.entries):
+            if other != path and other.endswith(INIT_EXTENSION) and posixpath.dirname(other) == directory:
+                self.drop(other)
+
+    def evict(self):
+        # Oldest first. An evicted segment may still be listed, the origin
+        # serves it from disk from then on
+        for path in list(self.entries):
+            if self.size <= self.max_bytes:
+                return
+            if not path.endswith(KEPT_EXTENSIONS):
+                self.drop(path)
+
+    def broadcast(self, data):
+        for writer in list(self.subscribers):
+            if writer.transport.get_write_buffer_size() > MAX_SUBSCRIBER_BUFFER:
+                self.subscribers.discard(writer)
+                writer.close()
+                continue
+            writer.write(data)
+
+    async def handle_upload(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except asyncio.IncompleteReadError:
+                    return
+                method, target, version, headers = parse_request(head)
+                path = relative_path(target)
+                if path is None:
+                    status = 400
+                elif method in ('PUT', 'POST'):
+                    if headers.get('expect', '').lower() == '100-continue':
+                        writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+                    # Nothing is published until the last byte is in, an
+                    # encoder killed mid-upload leaves the old file in place
+                    self.publish(path, await read_body(reader, headers))
+                    status = 201
+                elif method == 'DELETE':
+                    self.remove(path)
+                    status = 204
+                else:
+                    status = 405
+                keep_alive = status != 400 and headers.get('connection', '').lower() != 'close'
+                writer.write(f'HTTP/1.1 {status} {REASONS[status]}\r\nContent-Length: 0\r\n'
+                             f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode())
+                await writer.drain()
+                if not keep_alive:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_subscriber(self, reader, writer):
+        # A snapshot in publish order, then every change as it happens
+        for path, entry in sorted(self.entries.items(), key=lambda item: item[1].generation):
+            writer.write(update_frame('put', path, entry.generation, entry.mtime_ns, entry.body))
+        # Deletes since the newest file still count, the subscriber is at the
+        # store's generation now
+        writer.write(update_frame('sync', '', self.generation))
+        self.subscribers.add(writer)
+        try:
+            await reader.read()
+        except ConnectionError:
+            pass
+        finally:
+            self.subscribers.discard(writer)
+            writer.close()
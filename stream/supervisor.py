@@ -0,0 +1,142 @@
+import json
+import os
+import threading
+import time
+
+from metrics import LatencyHistogram
+
+
+class StreamStatus:
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.state = 'starting'
+        self.frames = 0
+        self.restarts = 0
+        self.last_error = None
+        self.dropped = 0
+        self.duplicated = 0
+        self.window_start = time.perf_counter_ns()
+        self.window_frames = 0
+        self.latency = LatencyHistogram()
+        # Per-frame fractions such as the share of tiles recomputed, kept as
+        # [total, count, max] per name like FrameMetrics does
+        self.gauges = {}
+
+    def on_frame(self, times, gauges=None):
+        with self.lock:
+            self.state = 'running'
+            self.frames += 1
+            self.window_frames += 1
+            self.latency.record(times['total'])
+            for name, value in (gauges or {}).items():
+                gauge = self.gauges.setdefault(name, [0.0, 0, 0.0])
+                gauge[0] += value
+                gauge[1] += 1
+                gauge[2] = max(gauge[2], value)
+
+    def on_drop(self, count=1):
+        with self.lock:
+            self.dropped += count
+
+    def on_duplicate(self, count=1):
+        with self.lock:
+            self.duplicated += count
+
+    def on_error(self, error):
+        with self.lock:
+            self.state = 'restarting'
+            self.restarts += 1
+            self.last_error = str(error)
+
+    def snapshot(self):
+        # Rates cover the time since the previous snapshot
+        with self.lock:
+            now = time.perf_counter_ns()
+            elapsed = (now - self.window_start) / 1e9
+            latency = self.latency.summary()
+            report = {
+                'name': self.name,
+                'state': self.state,
+                'frames': self.frames,
+                'dropped': self.dropped,
+                'duplicated': self.duplicated,
+                'fps': self.window_frames / elapsed if elapsed else 0.0,
+                'latency_p50_ms': latency['p50'] / 1e6 if latency['count'] else None,
+                'latency_p99_ms': latency['p99'] / 1e6 if latency['count'] else None,
+                'restarts': self.restarts,
+                'last_error': self.last_error,
+                'gauges': {name: {'mean': total / count, 'max': peak}
+                           for name, (total, count, peak) in self.gauges.items() if count},
+            }
+            self.window_start = now
+            self.window_frames = 0
+            self.latency.reset()
+            self.gauges.clear()
+        return report
+
+
+def format_latency(value):
+    return '-' if value is None else f'{value:.2f}'
+
+def print_status(reports):
+    print("\n{:<20} {:<12} {:>10} {:>8} {:>8} {:>8} {:>10} {:>10} {:>9}".format(
+        "Stream", "State", "Frames", "Dropped", "Repeated", "FPS", "p50 (ms)", "p99 (ms)", "Restarts"))
+    print("-" * 101)
+    for report in reports:
+        print("{:<20} {:<12} {:>10} {:>8} {:>8} {:>8.2f} {:>10} {:>10} {:>9}".format(
+            report['name'], report['state'], report['frames'], report['dropped'], report['duplicated'], report['fps'],
+            format_latency(report['latency_p50_ms']), format_latency(report['latency_p99_ms']), report['restarts']))
+    print("-" * 101)
+    for report in reports:
+        for name, gauge in report['gauges'].items():
+            print("{} {}: mean {:.1f}%, max {:.1f}%".format(
+                report['name'], name, gauge['mean'] * 100, gauge['max'] * 100))
+
+
+class Supervisor:
+    def __init__(self, streams, run_stream, compute_workers, status_interval=10, status_file=None):
+        self.streams = streams
+        # run_stream(stream, on_frame, on_error=, on_drop=, on_duplicate=, compute_slots=, stop_event=)
+        # owns one stream's reconnect loop, so each stream restarts on its own
+        self.run_stream = run_stream
+        self.status_interval = status_interval
+        self.status_file = status_file
+        # One interpreter shares the imports, color schedules and this budget
+        # of concurrent edge detection between every stream
+        self.compute_slots = threading.BoundedSemaphore(compute_workers)
+        self.stop_event = threading.Event()
+        self.statuses = {}
+        self.threads = []
+
+    def start(self):
+        names = [stream['name'] for stream in self.streams]
+        if len(set(names)) != len(names):
+            raise ValueError('Stream names in the registry must be unique')
+        for stream in self.streams:
+            status = StreamStatus(stream['name'])
+            self.statuses[stream['name']] = status
+            thread = threading.Thread(
+                target=self.run_stream, name=stream['name'], daemon=True, args=(stream, status.on_frame),
+                kwargs={'on_error': status.on_error, 'on_drop': status.on_drop, 'on_duplicate': status.on_duplicate,
+                        'compute_slots': self.compute_slots, 'stop_event': self.stop_event})
+            thread.start()
+            self.threads.append(thread)
+
+    def report(self):
+        reports = [status.snapshot() for status in self.statuses.values()]
+        print_status(reports)
+        if self.status_file:
+            # Replace atomically so readers never see a half-written report
+            tmp_file = self.status_file + '.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(reports, f, indent=2)
+            os.replace(tmp_file, self.status_file)
+
+    def run(self):
+        self.start()
+        try:
+            while not self.stop_event.wait(self.status_interval):
+                self.report()
+        except KeyboardInterrupt:
+            self.stop_event.set()